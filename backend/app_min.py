@@ -2,14 +2,21 @@ from __future__ import annotations
 import uuid
 
 import os, json, re, unicodedata
-from typing import Any, Dict, List, Optional, Tuple, Literal, Union, Annotated
+import threading
+import zlib
+import operator
+import copy
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import aclosing, closing
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Literal, Union, Annotated
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 import sqlite3
 import os, shutil, pathlib
 
 from fastapi.requests import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import FastAPI, Depends, HTTPException, status, Path, UploadFile, File, Depends, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from starlette.middleware.cors import CORSMiddleware
@@ -17,6 +24,9 @@ from pydantic import BaseModel, Field, field_validator, model_validator
 
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
+import httpx
+import openai
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 from langchain_core.prompts import ChatPromptTemplate
 
 import jwt
@@ -29,6 +39,7 @@ from sqlalchemy.sql import func
 from sqlalchemy.engine import Engine
 
 import pandas as pd
+import numpy as np
 from dotenv import load_dotenv
 from passlib.context import CryptContext
 from fastapi import Query
@@ -266,6 +277,174 @@ class ActivityLogStore:
 
 
 
+# ========= SqlGenCache =========
+class SqlGenCache:
+    """
+    Cache NL→SQL: LRU en memoria respaldado por una tabla SQLite (mismo history.db).
+    La clave ya incluye datasource, huella del esquema, dialecto, pregunta normalizada y max_rows.
+    KEY_VERSION cambia cuando cambia cómo se arma la clave; las filas de otra versión se borran.
+    """
+
+    KEY_VERSION = 2  # v2: _normalize_question conserva operadores y números
+
+    def __init__(self, db_path: str = "./backend/history.db", max_items: int = 1000) -> None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.max_items = max_items
+        self._mem: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._ensure_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        cx = sqlite3.connect(self.db_path)
+        cx.row_factory = sqlite3.Row
+        return cx
+
+    def _ensure_schema(self):
+        with self._conn() as cx:
+            cx.execute("""
+            CREATE TABLE IF NOT EXISTS sql_gen_cache(
+              cache_key TEXT PRIMARY KEY,   -- sha1 de la clave completa
+              ds_key TEXT NOT NULL,         -- 'conn:3' o 'url:<sha1>'
+              dialect TEXT NOT NULL,
+              question_norm TEXT NOT NULL,
+              max_rows INTEGER NOT NULL,
+              sql TEXT NOT NULL,
+              created_at TEXT NOT NULL,
+              hits INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+            cx.execute("CREATE INDEX IF NOT EXISTS idx_sql_gen_cache_ds ON sql_gen_cache(ds_key)")
+            cols = {r["name"] for r in cx.execute("PRAGMA table_info(sql_gen_cache)")}
+            if "key_version" not in cols:
+                cx.execute("ALTER TABLE sql_gen_cache ADD COLUMN key_version INTEGER NOT NULL DEFAULT 1")
+            # claves viejas (ej. v1 mezclaba "> 1000" con "< 1000"): fuera
+            cx.execute("DELETE FROM sql_gen_cache WHERE key_version != ?", (self.KEY_VERSION,))
+
+    @classmethod
+    def make_key(cls, *, ds_key: str, schema_hash: str, dialect: str, question_norm: str, max_rows: int) -> str:
+        raw = json.dumps(
+            [cls.KEY_VERSION, ds_key, schema_hash, dialect, question_norm, int(max_rows)], ensure_ascii=False
+        )
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, sql: str) -> None:
+        # llamar con self._lock tomado
+        self._mem[key] = sql
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            sql = self._mem.get(key)
+            if sql is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return sql
+        with self._conn() as cx:
+            row = cx.execute("SELECT sql FROM sql_gen_cache WHERE cache_key = ?", (key,)).fetchone()
+            if row:
+                cx.execute("UPDATE sql_gen_cache SET hits = hits + 1 WHERE cache_key = ?", (key,))
+        with self._lock:
+            if row:
+                self.hits += 1
+                self._remember(key, row["sql"])
+                return row["sql"]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, sql: str, *, ds_key: str, dialect: str, question_norm: str, max_rows: int) -> None:
+        with self._conn() as cx:
+            cx.execute("""
+              INSERT OR REPLACE INTO sql_gen_cache(
+                cache_key, ds_key, dialect, question_norm, max_rows, sql, created_at, key_version
+              ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, ds_key, dialect, question_norm, int(max_rows), sql,
+                  datetime.now(timezone.utc).isoformat(), self.KEY_VERSION))
+        with self._lock:
+            self._remember(key, sql)
+
+    def purge(self, *, ds_key: Optional[str] = None) -> int:
+        with self._conn() as cx:
+            if ds_key is None:
+                cur = cx.execute("DELETE FROM sql_gen_cache")
+            else:
+                cur = cx.execute("DELETE FROM sql_gen_cache WHERE ds_key = ?", (ds_key,))
+            deleted = int(cur.rowcount)
+        with self._lock:
+            # la memoria no guarda ds_key; se vacía completa (se repuebla desde SQLite)
+            self._mem.clear()
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        with self._conn() as cx:
+            stored = cx.execute("SELECT COUNT(*) AS c FROM sql_gen_cache").fetchone()["c"]
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "memory_items": len(self._mem),
+                "max_items": self.max_items,
+                "stored_items": stored,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# ========= LRUCache =========
+class LRUCache:
+    """LRU en memoria, thread-safe, con contadores de hit/miss/evicción."""
+
+    def __init__(self, max_items: int = 1000) -> None:
+        self.max_items = max_items
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        with self._lock:
+            if key is None:
+                n = len(self._items)
+                self._items.clear()
+                return n
+            return 1 if self._items.pop(key, None) is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+
 # ========= Env & App =========
 load_dotenv()
 app = FastAPI(title="DataChatbot MVP", version="0.1.0")
@@ -313,6 +492,7 @@ pwd_ctx = CryptContext(schemes=["argon2"], deprecated="auto")
 auth_scheme = HTTPBearer(auto_error=True)
 
 from fastapi import BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 import asyncio
 
 @app.on_event("startup")
@@ -492,6 +672,7 @@ def admin_revoke_session(
 DB_URL = os.getenv("AUTH_DB_URL", "sqlite:///./auth.db")
 history_store = HistoryStore("./backend/history.db")
 activity_log = ActivityLogStore("./backend/history.db")
+sql_gen_cache = SqlGenCache("./backend/history.db", max_items=int(os.getenv("SQL_CACHE_MAX", "1000")))
 def log_event(level: str, action: str, *, actor: str | None = None, path: str | None = None, meta: dict | None = None):
     try:
         activity_log.add(level=level, action=action, actor=actor, path=path, meta=meta or {})
@@ -649,12 +830,14 @@ def admin_ping(_: dict = Depends(require_roles(["admin"]))):
 
 def _validate_connection(sqlalchemy_url: str) -> None:
     """Levanta si no conecta / no se puede ejecutar SELECT 1."""
-    eng = _make_engine(sqlalchemy_url)
+    eng = engine_registry.get(sqlalchemy_url)
     try:
         with eng.connect() as c:
             c.execute(text("SELECT 1"))
-    finally:
-        eng.dispose()
+    except Exception:
+        # no dejes en el registro un engine que no conecta
+        engine_registry.discard(sqlalchemy_url)
+        raise
 
 
 @app.post("/admin/connections", response_model=ConnectionOut)
@@ -732,17 +915,158 @@ ALLOWED_EXTS = {".xlsx", ".xls", ".csv"}
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-def _save_upload_to_disk(up: UploadFile) -> dict:
+UPLOAD_TTL_HOURS = float(os.environ.get("UPLOAD_TTL_HOURS", "168"))         # sin acceso → se borra; 0 = nunca
+UPLOAD_USER_QUOTA_MB = int(os.environ.get("UPLOAD_USER_QUOTA_MB", "500"))    # por usuario; 0 = sin límite
+UPLOAD_TOTAL_QUOTA_MB = int(os.environ.get("UPLOAD_TOTAL_QUOTA_MB", "5120"))  # disco total; 0 = sin límite
+UPLOAD_SWEEP_SECONDS = int(os.environ.get("UPLOAD_SWEEP_SECONDS", "300"))
+_LEGACY_UPLOAD_RE = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(\.\w+)$")
+
+
+class UploadStore:
+    """
+    Registro de uploads direccionados por contenido: el archivo vive una sola vez en
+    UPLOAD_DIR/<sha256><ext> y cada upload es un file_id (con dueño, tamaño, creación y
+    último acceso) que apunta a ese hash. Re-subir el mismo workbook reutiliza el archivo
+    y todo lo derivado de él (copia columnar, perfil, índices, caches keyed por ruta).
+    """
+
+    def __init__(self, db_path: str = "./backend/history.db") -> None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._ensure_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        cx = sqlite3.connect(self.db_path)
+        cx.row_factory = sqlite3.Row
+        return cx
+
+    def _ensure_schema(self):
+        with self._conn() as cx:
+            cx.execute("""
+            CREATE TABLE IF NOT EXISTS upload_files(
+              file_id TEXT PRIMARY KEY,
+              content_hash TEXT NOT NULL,   -- sha256 del contenido
+              ext TEXT NOT NULL,
+              filename TEXT,
+              size_bytes INTEGER NOT NULL,
+              created_at TEXT NOT NULL,
+              owner TEXT,
+              last_accessed_at TEXT
+            )
+            """)
+            cols = {r["name"] for r in cx.execute("PRAGMA table_info(upload_files)")}
+            for col in ("owner", "last_accessed_at"):
+                if col not in cols:  # tablas creadas antes del registro de ciclo de vida
+                    cx.execute(f"ALTER TABLE upload_files ADD COLUMN {col} TEXT")
+            cx.execute("UPDATE upload_files SET last_accessed_at = created_at WHERE last_accessed_at IS NULL")
+            cx.execute("CREATE INDEX IF NOT EXISTS idx_upload_files_hash ON upload_files(content_hash)")
+            cx.execute("CREATE INDEX IF NOT EXISTS idx_upload_files_owner ON upload_files(owner)")
+            cx.execute("CREATE INDEX IF NOT EXISTS idx_upload_files_access ON upload_files(last_accessed_at)")
+
+    @staticmethod
+    def blob_path(content_hash: str, ext: str) -> str:
+        return os.path.join(UPLOAD_DIR, f"{content_hash}{ext}")
+
+    def add(
+        self, file_id: str, content_hash: str, ext: str, filename: Optional[str], size: int,
+        owner: Optional[str] = None,
+    ) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        with self._conn() as cx:
+            cx.execute(
+                "INSERT INTO upload_files(file_id, content_hash, ext, filename, size_bytes, created_at, "
+                "owner, last_accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, content_hash, ext, filename, size, now, owner, now),
+            )
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        with self._conn() as cx:
+            row = cx.execute("SELECT * FROM upload_files WHERE file_id = ?", (file_id,)).fetchone()
+        return dict(row) if row else None
+
+    def touch(self, file_id: str) -> None:
+        # a lo sumo una escritura por minuto y file_id
+        now = datetime.now(timezone.utc)
+        with self._conn() as cx:
+            cx.execute(
+                "UPDATE upload_files SET last_accessed_at = ? WHERE file_id = ? AND last_accessed_at < ?",
+                (now.isoformat(), file_id, (now - timedelta(seconds=60)).isoformat()),
+            )
+
+    def remove(self, file_id: str) -> Optional[int]:
+        """
+        Borra el file_id y devuelve cuántos file_id siguen apuntando al mismo contenido, o
+        None si ya no estaba (otro borrado/sweep ganó la carrera: no hay nada que liberar).
+        """
+        with closing(self._conn()) as cx, cx:
+            # borrar y contar en la misma transacción de escritura: dos remove concurrentes
+            # del mismo file_id no pueden ver ambos "última referencia"
+            cx.execute("BEGIN IMMEDIATE")
+            row = cx.execute("SELECT content_hash, ext FROM upload_files WHERE file_id = ?", (file_id,)).fetchone()
+            if not row:
+                return None
+            cx.execute("DELETE FROM upload_files WHERE file_id = ?", (file_id,))
+            (left,) = cx.execute(
+                "SELECT COUNT(*) FROM upload_files WHERE content_hash = ? AND ext = ?",
+                (row["content_hash"], row["ext"]),
+            ).fetchone()
+        return int(left)
+
+    def user_bytes(self, owner: str) -> int:
+        # lo que el usuario subió (un archivo deduplicado cuenta para cada dueño)
+        with self._conn() as cx:
+            (n,) = cx.execute(
+                "SELECT COALESCE(SUM(size_bytes), 0) FROM upload_files WHERE owner = ?", (owner,)
+            ).fetchone()
+        return int(n)
+
+    def total_bytes(self) -> int:
+        # disco real: cada contenido una sola vez
+        with self._conn() as cx:
+            (n,) = cx.execute(
+                "SELECT COALESCE(SUM(size_bytes), 0) FROM "
+                "(SELECT MAX(size_bytes) AS size_bytes FROM upload_files GROUP BY content_hash, ext)"
+            ).fetchone()
+        return int(n)
+
+    def expired(self, before: datetime) -> List[str]:
+        with self._conn() as cx:
+            rows = cx.execute(
+                "SELECT file_id FROM upload_files WHERE last_accessed_at < ?", (before.isoformat(),)
+            ).fetchall()
+        return [r["file_id"] for r in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._conn() as cx:
+            files, owners, blobs = cx.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT owner), COUNT(DISTINCT content_hash || ext) FROM upload_files"
+            ).fetchone()
+        return {
+            "files": int(files),
+            "owners": int(owners),
+            "stored_files": int(blobs),
+            "stored_bytes": self.total_bytes(),
+            "ttl_hours": UPLOAD_TTL_HOURS,
+            "user_quota_mb": UPLOAD_USER_QUOTA_MB,
+            "total_quota_mb": UPLOAD_TOTAL_QUOTA_MB,
+        }
+
+
+upload_store = UploadStore("./backend/history.db")
+
+
+def _save_upload_to_disk(up: UploadFile, owner: Optional[str] = None) -> dict:
     ext = pathlib.Path(up.filename or "").suffix.lower()
     if ext not in ALLOWED_EXTS:
         raise HTTPException(status_code=400, detail=f"Extensión no permitida: {ext}")
 
     file_id = str(uuid.uuid4())
-    server_path = os.path.join(UPLOAD_DIR, f"{file_id}{ext}")
+    tmp_path = os.path.join(UPLOAD_DIR, f".{file_id}{ext}.part")
 
-    # Medir tamaño mientras copiamos (streaming)
+    # Medir tamaño y hashear mientras copiamos (streaming)
     size = 0
-    with open(server_path, "wb") as out:
+    digest = hashlib.sha256()
+    with open(tmp_path, "wb") as out:
         while True:
             chunk = up.file.read(1024 * 1024)
             if not chunk:
@@ -751,34 +1075,798 @@ def _save_upload_to_disk(up: UploadFile) -> dict:
             if size > MAX_FILE_MB * 1024 * 1024:
                 try:
                     out.close()
-                    os.remove(server_path)
+                    os.remove(tmp_path)
                 except Exception:
                     pass
                 raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+            digest.update(chunk)
             out.write(chunk)
 
+    content_hash = digest.hexdigest()
+    server_path = UploadStore.blob_path(content_hash, ext)
+    deduplicated = os.path.exists(server_path)
+    try:
+        _check_upload_quota(owner, size, deduplicated)
+    except HTTPException:
+        os.remove(tmp_path)
+        raise
+    if deduplicated:
+        os.remove(tmp_path)  # mismo contenido ya almacenado: se reutiliza con sus derivados
+    else:
+        os.replace(tmp_path, server_path)
+    upload_store.add(file_id, content_hash, ext, up.filename, size, owner=owner)
+
+    # el hash ya calculado evita re-leer el archivo en file_content_hash()
+    st = os.stat(server_path)
+    content_hash_cache.put(f"{os.path.abspath(server_path)}|{st.st_mtime_ns}|{st.st_size}", content_hash)
+
     return {
         "file_id": file_id,
         "server_path": server_path,
         "filename": up.filename,
         "size_bytes": size,
         "mime": up.content_type or "application/octet-stream",
+        "content_hash": content_hash,
+        "deduplicated": deduplicated,
     }
 
+
+def _check_upload_quota(owner: Optional[str], size: int, deduplicated: bool) -> None:
+    if owner and UPLOAD_USER_QUOTA_MB and upload_store.user_bytes(owner) + size > UPLOAD_USER_QUOTA_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail="Cuota de almacenamiento del usuario excedida")
+    if deduplicated or not UPLOAD_TOTAL_QUOTA_MB:
+        return  # un duplicado no ocupa disco nuevo
+    limit = UPLOAD_TOTAL_QUOTA_MB * 1024 * 1024
+    if upload_store.total_bytes() + size > limit:
+        sweep_uploads()  # libera lo vencido antes de rechazar
+        if upload_store.total_bytes() + size > limit:
+            raise HTTPException(status_code=507, detail="Almacenamiento de archivos lleno")
+
+
 def _path_from_file_id(file_id: str) -> str:
-    # Busca cualquier extensión válida para ese file_id
-    for ext in ALLOWED_EXTS:
-        p = os.path.join(UPLOAD_DIR, f"{file_id}{ext}")
-        if os.path.exists(p):
-            return p
-    raise HTTPException(status_code=404, detail="file_id no encontrado")
+    entry = upload_store.get(file_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="file_id no encontrado")
+    p = UploadStore.blob_path(entry["content_hash"], entry["ext"])
+    if not os.path.exists(p):
+        raise HTTPException(status_code=404, detail="file_id no encontrado")
+    upload_store.touch(file_id)
+    return p
+
+
+def discard_upload(file_id: str) -> Tuple[Optional[str], int]:
+    """
+    Quita el file_id del registro. Si era la última referencia a ese contenido borra el
+    archivo, sus derivados y sus entradas en cache. Devuelve (ruta, referencias restantes).
+    """
+    entry = upload_store.get(file_id)
+    if entry is None:
+        return None, 0
+    path = UploadStore.blob_path(entry["content_hash"], entry["ext"])
+    shared = upload_store.remove(file_id)
+    if shared is None:
+        return None, 0  # ya lo quitó otro: el archivo puede seguir en uso por otros file_id
+    if shared == 0:
+        df_cache.invalidate_path(path)
+        result_cache.invalidate_path(path)
+        _remove_derived_files(path)
+        if os.path.exists(path):
+            os.remove(path)
+    return path, shared
+
+
+def sweep_uploads() -> int:
+    """
+    Desaloja uploads sin acceso en UPLOAD_TTL_HOURS, .part huérfanos y derivados a medio
+    construir (*.tmp-*: sqlite, copia columnar, json); devuelve cuántos file_id.
+    """
+    evicted = 0
+    if UPLOAD_TTL_HOURS > 0:
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=UPLOAD_TTL_HOURS)
+        for file_id in upload_store.expired(cutoff):
+            try:
+                if discard_upload(file_id)[0] is not None:
+                    evicted += 1
+            except Exception as e:
+                print(f"WARN: no se pudo desalojar {file_id}:", e)
+    stale = time() - 3600
+    for name in os.listdir(UPLOAD_DIR):
+        if not (name.endswith(".part") or ".tmp-" in name):
+            continue
+        p = os.path.join(UPLOAD_DIR, name)
+        try:
+            if os.path.getmtime(p) >= stale:
+                continue  # puede ser un upload o una ingesta todavía en curso
+            if os.path.isdir(p):
+                shutil.rmtree(p)  # <archivo>.cols.tmp-*
+            else:
+                os.remove(p)  # upload interrumpido o build que murió a mitad de camino
+        except FileNotFoundError:
+            pass  # otro proceso lo terminó o lo limpió entre listdir y acá
+        except OSError as e:
+            print(f"WARN: no se pudo limpiar {name}:", e)
+    return evicted
+
+
+def adopt_legacy_uploads() -> int:
+    """Registra (y pasa al store por contenido) los archivos <file_id><ext> previos al registro."""
+    adopted = 0
+    for name in os.listdir(UPLOAD_DIR):
+        m = _LEGACY_UPLOAD_RE.match(name)
+        if not m or m.group(2).lower() not in ALLOWED_EXTS or upload_store.get(m.group(1)):
+            continue
+        legacy = os.path.join(UPLOAD_DIR, name)
+        digest = hashlib.sha256()
+        with open(legacy, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        ext = m.group(2).lower()
+        size = os.path.getsize(legacy)
+        _remove_derived_files(legacy)
+        target = UploadStore.blob_path(digest.hexdigest(), ext)
+        if os.path.exists(target):
+            os.remove(legacy)
+        else:
+            os.replace(legacy, target)
+        upload_store.add(m.group(1), digest.hexdigest(), ext, None, size)
+        adopted += 1
+    return adopted
+
+
+@app.on_event("startup")
+async def _upload_sweeper_start():
+    try:
+        n = await asyncio.to_thread(adopt_legacy_uploads)  # hashea archivos: fuera del event loop
+        if n:
+            print(f"[uploads] {n} archivo(s) previos registrados")
+    except Exception as e:
+        print("WARN adopción de uploads previos:", e)
+
+    async def _sweeper():
+        while True:
+            try:
+                n = await asyncio.to_thread(sweep_uploads)
+                if n:
+                    print(f"[uploads] {n} upload(s) vencidos desalojados")
+            except Exception as e:
+                print("WARN upload sweeper:", e)
+            await asyncio.sleep(UPLOAD_SWEEP_SECONDS)
+    asyncio.create_task(_sweeper())
+
+
+# ========= Ingesta columnar (Feather) =========
+# Tras el upload cada hoja se guarda como Feather sin comprimir en <archivo>.cols/,
+# así las lecturas posteriores son un mmap en lugar de re-parsear XML/CSV.
+try:
+    import pyarrow.feather as feather
+except ImportError:  # opcional: sin pyarrow se lee siempre el archivo original
+    feather = None
+
+
+def _columnar_dir(path: str) -> str:
+    return path + ".cols"
+
+
+def _columnar_meta(path: str) -> Optional[Dict[str, Any]]:
+    """meta.json de la copia columnar si existe y corresponde a la versión actual del archivo."""
+    meta_path = os.path.join(_columnar_dir(path), "meta.json")
+    if feather is None or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if (meta.get("source_mtime"), meta.get("source_size")) != (st.st_mtime, st.st_size):
+        return None
+    return meta
+
+
+def _columnar_sheet(meta: Dict[str, Any], sheet_name: Optional[Union[int, str]]) -> Optional[Dict[str, Any]]:
+    sheets = meta.get("sheets") or []
+    if meta.get("csv"):
+        sh = sheets[0] if sheets else None
+    elif sheet_name is None or isinstance(sheet_name, int):
+        idx = sheet_name or 0
+        sh = sheets[idx] if 0 <= idx < len(sheets) else None
+    else:
+        sh = next((x for x in sheets if x["name"] == sheet_name), None)
+    return sh if sh and sh.get("file") else None
+
+
+def _read_columnar_table(path: str, sheet_name: Optional[Union[int, str]] = 0):
+    """pyarrow.Table mapeado en memoria, o None si no hay copia columnar para esa hoja."""
+    meta = _columnar_meta(path)
+    sh = _columnar_sheet(meta, sheet_name) if meta else None
+    if not sh:
+        return None
+    try:
+        return feather.read_table(os.path.join(_columnar_dir(path), sh["file"]), memory_map=True)
+    except Exception as e:
+        print("WARN: copia columnar ilegible, se usa el original:", e)
+        return None
+
+
+def read_upload_frames(path: str) -> Optional[Dict[str, pd.DataFrame]]:
+    """Todas las hojas (o el CSV como "__csv__") parseadas una vez; None si el CSV va por chunks."""
+    if _csv_needs_streaming(path):
+        return None
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return {"__csv__": pd.read_csv(path)}
+    return pd.read_excel(path, sheet_name=None, engine="xlrd" if ext == ".xls" else None)
+
+
+def ingest_columnar(path: str, frames: Optional[Dict[str, pd.DataFrame]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Convierte cada hoja (o el CSV) a Feather y registra dtypes. Devuelve el meta escrito.
+    frames: hojas ya parseadas (read_upload_frames) para no volver a leer el archivo.
+    """
+    if feather is None:
+        return None
+    ext = os.path.splitext(path)[1].lower()
+    st = os.stat(path)
+    if _csv_needs_streaming(path):
+        return None  # no cabe en memoria: se ejecuta por chunks sobre el CSV
+    if frames is None:
+        frames = read_upload_frames(path)
+
+    out_dir = _columnar_dir(path)
+    tmp_dir = f"{out_dir}.tmp-{uuid4().hex[:8]}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    sheets = []
+    for i, (name, df) in enumerate(frames.items()):
+        df = optimize_dtypes(
+            df, label=f"{os.path.basename(path)}[{name}]", profile=get_column_profile(path, str(name))
+        )
+        entry = {
+            "name": str(name),
+            "file": None,
+            "rows": int(len(df)),
+            "columns": [str(c) for c in df.columns],
+            "dtypes": {str(c): str(df[c].dtype) for c in df.columns},
+        }
+        # Feather exige nombres de columna str y tipos homogéneos por columna
+        if all(isinstance(c, str) for c in df.columns):
+            try:
+                feather.write_feather(df, os.path.join(tmp_dir, f"{i}.feather"), compression="uncompressed")
+                entry["file"] = f"{i}.feather"
+            except Exception as e:
+                print(f"WARN: hoja {name!r} no convertible a Feather:", e)
+        sheets.append(entry)
+
+    meta = {
+        "csv": ext == ".csv",
+        "source_mtime": st.st_mtime,
+        "source_size": st.st_size,
+        "sheets": sheets,
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return meta
+
+
+# ========= Índice de filas CSV =========
+# Offsets en bytes cada CSV_INDEX_STEP filas: total en O(1) y cualquier página es
+# un seek + leer a lo sumo STEP-1 líneas + read_csv de `limit` filas.
+CSV_INDEX_STEP = int(os.getenv("CSV_INDEX_STEP", "1000"))
+
+
+def _csv_index_path(path: str) -> str:
+    return path + ".rowidx.json"
+
+
+_CSV_INDEX_VERSION = 2  # 2: cuenta registros (como pandas), no líneas físicas
+
+
+def _csv_records(f):
+    """
+    (offset, bytes) de cada registro desde la posición actual, con la misma definición de fila
+    que read_csv: un campo entre comillas puede abarcar varias líneas y las líneas en blanco
+    no cuentan. Las comillas escapadas ("") no cambian la paridad.
+    """
+    pos = f.tell()
+    start, quotes = pos, 0
+    for line in iter(f.readline, b""):
+        pos += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2:
+            continue  # el registro sigue en la próxima línea
+        if line.strip() or pos - len(line) != start:
+            yield start, pos - start
+        start, quotes = pos, 0
+
+
+def build_csv_row_index(path: str, step: int = CSV_INDEX_STEP) -> Dict[str, Any]:
+    st = os.stat(path)
+    offsets: List[int] = []
+    total = 0
+    with open(path, "rb") as f:
+        next(_csv_records(f), None)  # header
+        for start, _ in _csv_records(f):
+            if total % step == 0:
+                offsets.append(start)
+            total += 1
+    idx = {
+        "version": _CSV_INDEX_VERSION,
+        "source_mtime": st.st_mtime,
+        "source_size": st.st_size,
+        "step": step,
+        "total": total,
+        "offsets": offsets,
+    }
+    tmp = f"{_csv_index_path(path)}.tmp-{uuid4().hex[:8]}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(idx, f)
+    os.replace(tmp, _csv_index_path(path))
+    return idx
+
+
+def get_csv_row_index(path: str) -> Dict[str, Any]:
+    """Índice persistido junto al archivo; se (re)construye si falta o el CSV cambió."""
+    try:
+        with open(_csv_index_path(path), "r", encoding="utf-8") as f:
+            idx = json.load(f)
+        st = os.stat(path)
+        if (idx.get("version"), idx.get("source_mtime"), idx.get("source_size")) == (
+            _CSV_INDEX_VERSION, st.st_mtime, st.st_size
+        ):
+            return idx
+    except (OSError, ValueError):
+        pass
+    return build_csv_row_index(path)
+
+
+def read_csv_window(path: str, columns: List[str], offset: int, limit: int) -> pd.DataFrame:
+    idx = get_csv_row_index(path)
+    if offset >= idx["total"]:
+        return pd.DataFrame(columns=columns)
+    block, skip = divmod(offset, idx["step"])
+    with open(path, "rb") as f:
+        f.seek(idx["offsets"][block])
+        records = _csv_records(f)
+        for _ in range(skip):
+            next(records)  # el generador deja f justo al final del registro
+        return pd.read_csv(f, header=None, names=columns, nrows=limit)
+
+
+# ========= Ingesta a SQLite indexado =========
+# Modo opcional: cada hoja se importa a <archivo>.sqlite (una tabla por hoja) con índices
+# en columnas de baja cardinalidad; así el Excel/CSV se puede responder por sql_stages.
+INGEST_SQLITE = os.getenv("INGEST_SQLITE", "0") == "1"
+SQLITE_INDEX_MAX_RATIO = float(os.getenv("SQLITE_INDEX_MAX_RATIO", "0.2"))  # únicos / filas
+
+
+def _sqlite_path(path: str) -> str:
+    return path + ".sqlite"
+
+
+def _sqlite_conn_key(path: str) -> str:
+    return "file:" + os.path.basename(path)
+
+
+def _sql_table_name(name: str, taken: set) -> str:
+    base = re.sub(r"\W+", "_", _normalize(str(name))).strip("_") or "hoja"
+    if base[0].isdigit():
+        base = "t_" + base
+    out, i = base, 2
+    while out in taken:
+        out, i = f"{base}_{i}", i + 1
+    taken.add(out)
+    return out
+
+
+def _index_candidates(df: pd.DataFrame) -> List[str]:
+    # columnas con pocos valores distintos (filtros típicos: genero, sede, departamento...)
+    n = max(len(df), 1)
+    out = []
+    for c in df.columns:
+        u = df[c].nunique(dropna=True)
+        if 1 < u <= SQLITE_INDEX_MAX_RATIO * n:
+            out.append(str(c))
+    return out
+
+
+def _to_sql_frame(df: pd.DataFrame) -> pd.DataFrame:
+    cats = {c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.astype(cats) if cats else df
+
+
+def _sql_ident(name: str) -> str:
+    # los encabezados vienen del archivo subido: se citan siempre, nunca se interpolan crudos
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def ingest_sqlite(path: str) -> str:
+    """Construye <archivo>.sqlite (si falta o el archivo cambió) y devuelve su URL SQLAlchemy."""
+    db_path = _sqlite_path(path)
+    url = f"sqlite:///{os.path.abspath(db_path)}"
+    st = os.stat(path)
+    # versión del archivo origen guardada en PRAGMA user_version (no agrega tablas al esquema)
+    stamp = zlib.crc32(json.dumps([st.st_mtime, st.st_size]).encode("utf-8")) & 0x7FFFFFFF
+    if os.path.exists(db_path):
+        try:
+            with closing(sqlite3.connect(db_path)) as cx:
+                if cx.execute("PRAGMA user_version").fetchone()[0] == stamp:
+                    return url
+        except sqlite3.Error:
+            pass
+
+    tmp = f"{db_path}.tmp-{uuid4().hex[:8]}"
+    taken: set = set()
+    indexes: Dict[str, List[str]] = {}
+    try:
+        with closing(sqlite3.connect(tmp)) as cx:
+            if _csv_needs_streaming(path):
+                table = _sql_table_name("datos", taken)
+                for i, chunk in enumerate(pd.read_csv(path, chunksize=CSV_CHUNK_ROWS)):
+                    if i == 0:
+                        indexes[table] = _index_candidates(chunk)
+                    chunk.to_sql(table, cx, index=False, if_exists="append")
+            else:
+                for sh in get_workbook_meta(path)["sheets"]:
+                    table = _sql_table_name("datos" if sh["name"] == "__csv__" else sh["name"], taken)
+                    df = load_dataframe(path, sh["name"] if sh["name"] != "__csv__" else 0)
+                    indexes[table] = _index_candidates(df)
+                    _to_sql_frame(df).to_sql(table, cx, index=False, if_exists="replace")
+            for table, cols in indexes.items():
+                for c in cols:
+                    ix = re.sub(r"\W+", "_", f"ix_{table}_{c}")
+                    cx.execute(f"CREATE INDEX IF NOT EXISTS {_sql_ident(ix)} ON {_sql_ident(table)} ({_sql_ident(c)})")
+            cx.execute(f"PRAGMA user_version = {int(stamp)}")
+            cx.commit()
+        os.replace(tmp, db_path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    # conexiones viejas del pool apuntan al archivo reemplazado
+    engine_registry.discard(_sqlite_conn_key(path))
+    schema_cache.invalidate(_sqlite_conn_key(path))
+    print(f"[sqlite] {os.path.basename(path)} → {len(indexes)} tabla(s), índices: {indexes}")
+    return url
+
+
+def _remove_derived_files(path: str) -> None:
+    # todo lo que se genera a partir de un upload vive junto a él
+    shutil.rmtree(_columnar_dir(path), ignore_errors=True)
+    workbook_meta_cache.invalidate(os.path.abspath(path))
+    column_profile_cache.invalidate(os.path.abspath(path))
+    engine_registry.discard(_sqlite_conn_key(path))
+    for p in (_csv_index_path(path), _workbook_meta_path(path), _sqlite_path(path), _profile_path(path)):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+# ========= Metadata de workbook =========
+# Nombres de hoja, filas y encabezado por hoja; se captura una vez (upload o primer
+# acceso) en <archivo>.meta.json y se sirve desde memoria en /excel/sheets y preview.
+workbook_meta_cache = LRUCache(max_items=int(os.getenv("WORKBOOK_META_MAX", "1000")))
+
+
+def _workbook_meta_path(path: str) -> str:
+    return path + ".meta.json"
+
+
+def build_workbook_meta(path: str) -> Dict[str, Any]:
+    st = os.stat(path)
+    ext = os.path.splitext(path)[1].lower()
+    sheets: List[Dict[str, Any]] = []
+    if ext == ".csv":
+        header = pd.read_csv(path, nrows=0).columns
+        sheets.append({"name": "__csv__", "rows": int(get_csv_row_index(path)["total"]),
+                       "columns": [str(c) for c in header]})
+    elif ext == ".xls":
+        with pd.ExcelFile(path, engine="xlrd") as xf:
+            for sh in xf.book.sheets():
+                header = sh.row_values(0) if sh.nrows else []
+                sheets.append({"name": sh.name, "rows": max(0, sh.nrows - 1),
+                               "columns": _xlsx_header([v if v != "" else None for v in header])})
+    else:
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+                max_row = ws.max_row
+                if max_row is None:
+                    # sin <dimension> en el XML: se cuenta una vez en streaming
+                    ws.reset_dimensions()
+                    max_row = sum(1 for _ in ws.iter_rows(values_only=True))
+                sheets.append({"name": ws.title, "rows": max(0, int(max_row) - 1),
+                               "columns": _xlsx_header(header)})
+        finally:
+            wb.close()
+
+    meta = {"csv": ext == ".csv", "source_mtime": st.st_mtime, "source_size": st.st_size, "sheets": sheets}
+    tmp = f"{_workbook_meta_path(path)}.tmp-{uuid4().hex[:8]}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, _workbook_meta_path(path))
+    return meta
+
+
+def get_workbook_meta(path: str) -> Dict[str, Any]:
+    """Memoria → <archivo>.meta.json → construir (una sola vez por versión del archivo)."""
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    meta = workbook_meta_cache.get(key)
+    if meta is not None and (meta["source_mtime"], meta["source_size"]) == (st.st_mtime, st.st_size):
+        return meta
+    try:
+        with open(_workbook_meta_path(path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if (meta.get("source_mtime"), meta.get("source_size")) != (st.st_mtime, st.st_size):
+            meta = None
+    except (OSError, ValueError):
+        meta = None
+    if meta is None:
+        meta = build_workbook_meta(path)
+    workbook_meta_cache.put(key, meta)
+    return meta
+
+
+def _workbook_sheet_meta(meta: Dict[str, Any], sheet_name: Optional[Union[int, str]]) -> Dict[str, Any]:
+    sheets = meta["sheets"]
+    if meta.get("csv") or sheet_name is None:
+        return sheets[0]
+    if isinstance(sheet_name, int):
+        if not 0 <= sheet_name < len(sheets):
+            raise ValueError(f"Hoja fuera de rango: {sheet_name}")
+        return sheets[sheet_name]
+    for sh in sheets:
+        if sh["name"] == sheet_name:
+            return sh
+    raise ValueError(f"Hoja no encontrada: {sheet_name}")
+
+
+# ========= Perfil de columnas =========
+# Una pasada (por chunks) al subir el archivo: filas, nulos, distintos (exacto o HLL),
+# min/max y top-k por columna, persistido en <archivo>.profile.json.
+PROFILE_TOPK = int(os.getenv("PROFILE_TOPK", "10"))
+PROFILE_TRACK_VALUES = int(os.getenv("PROFILE_TRACK_VALUES", "1000"))  # conteos exactos hasta aquí
+_HLL_P = 12  # 4096 registros, error típico ~1.6%
+
+column_profile_cache = LRUCache(max_items=int(os.getenv("PROFILE_CACHE_MAX", "1000")))
+
+
+def _json_safe(v: Any) -> Any:
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return None if isinstance(v, float) and not math.isfinite(v) else v
+    if isinstance(v, np.generic):
+        return _json_safe(v.item())
+    return str(v)
+
+
+class _ColumnProfiler:
+    """Acumulador por columna; add() recibe chunks sucesivos."""
+
+    def __init__(self, dtype: str) -> None:
+        self.dtype = dtype
+        self.nulls = 0
+        self.min: Any = None
+        self.max: Any = None
+        self.counts: Optional[pd.Series] = pd.Series(dtype="int64")
+        self.counts_complete = True
+        self.hll = np.zeros(1 << _HLL_P, dtype=np.uint8)
+
+    def add(self, col: pd.Series) -> None:
+        self.nulls += int(col.isna().sum())
+        values = col.dropna()
+        if values.empty:
+            return
+        if pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_datetime64_any_dtype(values.dtype):
+            lo, hi = values.min(), values.max()
+            self.min = lo if self.min is None else min(self.min, lo)
+            self.max = hi if self.max is None else max(self.max, hi)
+
+        # HyperLogLog: índice = primeros p bits del hash, rango = ceros a la izquierda del resto + 1
+        h = pd.util.hash_pandas_object(values.astype(str), index=False).to_numpy()
+        idx = (h >> np.uint64(64 - _HLL_P)).astype(np.int64)
+        w = (h & np.uint64((1 << (64 - _HLL_P)) - 1)).astype(np.float64)
+        bitlen = np.where(w > 0, np.floor(np.log2(np.maximum(w, 1))) + 1, 0)
+        rank = ((64 - _HLL_P) - bitlen + 1).astype(np.uint8)
+        np.maximum.at(self.hll, idx, rank)
+
+        # conteos exactos mientras haya pocos valores distintos; luego solo los más frecuentes
+        vc = values.value_counts()
+        self.counts = vc if self.counts.empty else self.counts.add(vc, fill_value=0)
+        if len(self.counts) > PROFILE_TRACK_VALUES:
+            self.counts = self.counts.nlargest(PROFILE_TRACK_VALUES)
+            self.counts_complete = False
+
+    def _hll_estimate(self) -> int:
+        m = float(1 << _HLL_P)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / float(np.sum(np.power(2.0, -self.hll.astype(np.float64))))
+        zeros = int(np.count_nonzero(self.hll == 0))
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)  # linear counting para cardinalidades chicas
+        return int(round(est))
+
+    def result(self) -> Dict[str, Any]:
+        exact = self.counts_complete
+        top = self.counts.sort_values(ascending=False).head(PROFILE_TOPK)
+        if not exact:
+            top = top[top > 1]  # en columnas casi únicas el top-k no dice nada
+        return {
+            "dtype": self.dtype,
+            "nulls": self.nulls,
+            "distinct": int(len(self.counts)) if exact else self._hll_estimate(),
+            "distinct_exact": exact,
+            "min": _json_safe(self.min),
+            "max": _json_safe(self.max),
+            "top": [[_json_safe(k), int(v)] for k, v in top.items()],
+            # con conteos completos se conocen todos los valores (validación de filtros)
+            "values": [_json_safe(k) for k in self.counts.index] if exact else None,
+        }
+
+
+def _profile_frames(frames, dtypes: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    rows = 0
+    profilers: Dict[str, _ColumnProfiler] = {}
+    for chunk in frames:
+        rows += len(chunk)
+        for c in chunk.columns:
+            if c not in profilers:
+                profilers[c] = _ColumnProfiler((dtypes or {}).get(str(c)) or str(chunk[c].dtype))
+            profilers[c].add(chunk[c])
+    return {"rows": rows, "columns": {str(c): p.result() for c, p in profilers.items()}}
+
+
+def build_column_profile(path: str, frames: Optional[Dict[str, pd.DataFrame]] = None) -> Dict[str, Any]:
+    """frames: hojas ya parseadas (las mismas que recibe ingest_columnar); si no, se lee el archivo."""
+    st = os.stat(path)
+    sheets = []
+    if frames is None and path.lower().endswith(".csv"):
+        # streaming: memoria acotada por CSV_CHUNK_ROWS aunque el CSV sea enorme
+        prof = _profile_frames(pd.read_csv(path, chunksize=CSV_CHUNK_ROWS))
+        sheets.append({"name": "__csv__", **prof})
+    else:
+        if frames is None:
+            frames = read_upload_frames(path)
+        for name, df in frames.items():
+            slices = (df.iloc[i:i + CSV_CHUNK_ROWS] for i in range(0, max(len(df), 1), CSV_CHUNK_ROWS))
+            sheets.append({"name": str(name), **_profile_frames(slices)})
+
+    profile = {
+        "csv": path.lower().endswith(".csv"),
+        "source_mtime": st.st_mtime,
+        "source_size": st.st_size,
+        "sheets": sheets,
+    }
+    tmp = f"{_profile_path(path)}.tmp-{uuid4().hex[:8]}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(tmp, _profile_path(path))
+    column_profile_cache.put(os.path.abspath(path), profile)
+    return profile
+
+
+def _profile_path(path: str) -> str:
+    return path + ".profile.json"
+
+
+def get_column_profile(path: str, sheet_name: Optional[Union[int, str]] = 0) -> Optional[Dict[str, Any]]:
+    """Perfil de la hoja si ya fue calculado (no construye: en la pregunta no se re-escanea)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = os.path.abspath(path)
+    profile = column_profile_cache.get(key)
+    if profile is None:
+        try:
+            with open(_profile_path(path), "r", encoding="utf-8") as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            return None
+        column_profile_cache.put(key, profile)
+    if (profile.get("source_mtime"), profile.get("source_size")) != (st.st_mtime, st.st_size):
+        return None
+    try:
+        return _workbook_sheet_meta(profile, sheet_name)
+    except ValueError:
+        return None
+
+
+def _plan_columns_hint(schema: Dict[str, Any], profile: Optional[Dict[str, Any]]) -> Any:
+    """Columnas para el prompt del planner; con perfil se agregan tipo y valores frecuentes."""
+    if not profile:
+        return schema["columns"]
+    hints = {}
+    for c in schema["columns"]:
+        p = profile["columns"].get(str(c))
+        if not p:
+            hints[str(c)] = str(schema["dtypes"].get(c, ""))
+            continue
+        h = f"{schema['dtypes'].get(c, p['dtype'])}, {p['distinct']} distintos"
+        if p["min"] is not None:
+            h += f", rango {p['min']}..{p['max']}"
+        elif p["distinct_exact"] and p["distinct"] <= 20:
+            h += ", valores: " + ", ".join(str(v) for v, _ in p["top"])
+        hints[str(c)] = h
+    return hints
+
+
+def validate_plan_filters(plan: dict, profile: Optional[Dict[str, Any]]) -> List[str]:
+    """
+    Contrasta valores de filtros ==/!=/in/not in con los valores conocidos del perfil.
+    Corrige mayúsculas/tildes ('it' → 'IT') y avisa si el valor no existe.
+    """
+    notices: List[str] = []
+    if not profile:
+        return notices
+    for f in plan.get("filters") or []:
+        if not isinstance(f, dict) or f.get("operator") not in ("==", "!=", "in", "not in"):
+            continue
+        p = profile["columns"].get(str(f.get("column")))
+        if not p or p.get("values") is None:
+            continue
+        known = {_normalize(str(v)): v for v in p["values"]}
+        many = isinstance(f.get("value"), (list, tuple))
+        fixed = []
+        for v in (f["value"] if many else [f.get("value")]):
+            if v in p["values"]:
+                fixed.append(v)
+            elif _normalize(str(v)) in known:
+                fixed.append(known[_normalize(str(v))])
+            else:
+                fixed.append(v)
+                notices.append(f"El valor '{v}' no aparece en la columna '{f['column']}'.")
+        f["value"] = fixed if many else fixed[0]
+    return notices
+
+
+def _ingest_upload(server_path: str) -> None:
+    # corre en background tras /files/upload; si falla, los lectores usan el original
+    try:
+        get_workbook_meta(server_path)
+    except Exception as e:
+        print("WARN: no se pudo leer la metadata del workbook:", e)
+    # un solo parseo del archivo: perfil y copia columnar salen de los mismos frames
+    # (CSV grande: None → el perfil va por chunks y no hay copia columnar)
+    try:
+        frames = read_upload_frames(server_path)
+    except Exception as e:
+        print("WARN: no se pudo leer el archivo:", e)
+        return
+    try:
+        build_column_profile(server_path, frames)  # antes de la columnar: el optimizador de dtypes lo usa
+    except Exception as e:
+        print("WARN: no se pudo perfilar el archivo:", e)
+    try:
+        ingest_columnar(server_path, frames)
+    except Exception as e:
+        print("WARN: ingesta columnar falló:", e)
+    frames = None  # libera las hojas antes de la ingesta SQLite
+    if INGEST_SQLITE:
+        try:
+            ingest_sqlite(server_path)
+        except Exception as e:
+            print("WARN: ingesta SQLite falló:", e)
+
 
 @app.post("/files/upload")
-def upload_file(file: UploadFile = File(...), user=Depends(require_non_admin)):
-    meta = _save_upload_to_disk(file)
+def upload_file(
+    background: BackgroundTasks,
+    file: UploadFile = File(...),
+    user=Depends(require_non_admin),
+):
+    meta = _save_upload_to_disk(file, owner=user.get("sub") or user.get("email"))
+    # contenido ya conocido: sus derivados existen (salvo que la ingesta anterior fallara)
+    if not meta["deduplicated"] or get_column_profile(meta["server_path"]) is None:
+        background.add_task(_ingest_upload, meta["server_path"])
     log_event("info", "file_upload", actor=user.get("sub") or user.get("email"), path="/files/upload",
-              meta={"filename": meta["filename"], "size": meta["size_bytes"], "mime": meta["mime"]})
-    # (Opcional) registrar en tu store/BD si quieres TTL/limpieza
+              meta={"filename": meta["filename"], "size": meta["size_bytes"], "mime": meta["mime"],
+                    "deduplicated": meta["deduplicated"]})
     return {
         "file_id": meta["file_id"],
         "filename": meta["filename"],
@@ -787,6 +1875,36 @@ def upload_file(file: UploadFile = File(...), user=Depends(require_non_admin)):
     }
 
 
+@app.delete("/files/{file_id}")
+def delete_file(file_id: str, user=Depends(require_non_admin)):
+    # solo el dueño puede borrarlo; a otro usuario se le responde como si no existiera
+    entry = upload_store.get(file_id)
+    if entry is None or entry.get("owner") != (user.get("sub") or user.get("email")):
+        raise HTTPException(status_code=404, detail="file_id no encontrado")
+    # otros file_id con el mismo contenido siguen usando el archivo y sus derivados
+    try:
+        server_path, shared = discard_upload(file_id)
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"No se pudo borrar el archivo: {e}")
+    if server_path is None:
+        raise HTTPException(status_code=404, detail="file_id no encontrado")
+    log_event("info", "file_delete", actor=user.get("sub") or user.get("email"), path=f"/files/{file_id}",
+              meta={"file": os.path.basename(server_path), "shared": shared})
+    return {"ok": True, "file_id": file_id}
+
+
+@app.get("/admin/uploads")
+def admin_upload_stats(_: dict = Depends(require_roles(["admin"]))):
+    return upload_store.stats()
+
+
+@app.post("/admin/uploads/sweep")
+def admin_upload_sweep(admin=Depends(require_roles(["admin"]))):
+    evicted = sweep_uploads()
+    log_event("info", "uploads_sweep", actor=admin["email"], path="/admin/uploads/sweep", meta={"evicted": evicted})
+    return {"evicted": evicted}
+
+
 def _unwrap_code_block(s: str) -> str:
     s = s.strip()
     m = re.search(r"```(?:python)?\s*(.*?)\s*```", s, re.S | re.I)
@@ -817,6 +1935,17 @@ def _normalize(txt: str) -> str:
     return txt
 
 
+def _normalize_question(txt: str) -> str:
+    """
+    Clave de caches: _normalize + espacios colapsados, sin ¿?¡!;: ni puntos/comas de
+    frase. Operadores (<, >, =, -), signos y números (3.5, 1,000) quedan tal cual:
+    "salario > 1000" y "salario < 1000" son preguntas distintas.
+    """
+    txt = re.sub(r"[¿?¡!;:]", " ", _normalize(txt or ""))
+    txt = re.sub(r"(?<!\d)[.,]|[.,](?!\d)", " ", txt)  # conserva separadores decimales/miles
+    return " ".join(txt.split())
+
+
 def _detect_operation(qnorm: str) -> str:
     if any(w in qnorm for w in ["promedio", "media"]):
         return "mean"
@@ -1000,14 +2129,14 @@ def build_pandas_expr(plan: dict) -> str:
     gcols_repr = "[" + ",".join(repr(c) for c in group_by) + "]"
     if op == "count":
         return (
-            f"out = {base_df}.groupby({gcols_repr}).size()"
+            f"out = {base_df}.groupby({gcols_repr}, observed=True).size()"
             f".reset_index(name='count')"
         )
 
     if not target:
         # si el LLM olvidó target, contamos filas por grupo
         return (
-            f"out = {base_df}.groupby({gcols_repr}).size()"
+            f"out = {base_df}.groupby({gcols_repr}, observed=True).size()"
             f".reset_index(name='count')"
         )
 
@@ -1022,22 +2151,469 @@ def build_pandas_expr(plan: dict) -> str:
         raise ValueError(f"Operación no soportada: {op}")
 
     return (
-        f"out = {base_df}.groupby({gcols_repr})[{repr(target)}].{op_map[op]}()"
+        f"out = {base_df}.groupby({gcols_repr}, observed=True)[{repr(target)}].{op_map[op]}()"
         f".reset_index(name='{op}_" + str(target) + "')"
     )
 
 
 # =========================
-# LLM
+# Ejecución directa del plan (sin generar/evaluar código)
 # =========================
-# justo antes de crear el LLM
+_CMP_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+_STR_OPS = {"contains", "startswith", "endswith"}
+# filtros de texto son los más caros: a igual selectividad van al final
+_OP_COST = {"in": 1, "not in": 1, "contains": 3, "startswith": 2, "endswith": 2}
+
+
+# fechas en texto que optimize_dtypes pasa a datetime64 (y que vuelven a este mismo texto)
+_ISO_DATE = r"^\d{4}-\d{2}-\d{2}$"
+_ISO_DATE_FMT = "%Y-%m-%d"
+
+
+def _filter_date(val: str) -> Optional[pd.Timestamp]:
+    # valor de filtro sobre una columna datetime64: solo AAAA-MM-DD, nunca se adivina D/M vs M/D
+    ts = pd.to_datetime(val.strip(), format=_ISO_DATE_FMT, errors="coerce")
+    return None if pd.isna(ts) else ts
+
+
+def _filter_mask(df: pd.DataFrame, f: dict) -> Optional[pd.Series]:
+    """Máscara booleana vectorizada de un filtro; None si el operador no se soporta (se ignora)."""
+    col = f.get("column")
+    op = (f.get("operator") or "").lower()
+    val = f.get("value")
+    is_date = pd.api.types.is_datetime64_any_dtype(df[col].dtype)
+    if op in _CMP_OPS:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype) and op not in ("==", "!="):
+            s = s.astype(s.cat.categories.dtype)  # category no ordenada no admite < >
+        if is_date and isinstance(val, str):
+            ts = _filter_date(val)
+            if ts is None:
+                # no es AAAA-MM-DD: se compara como texto, igual que antes de convertir la columna
+                return _CMP_OPS[op](s.dt.strftime(_ISO_DATE_FMT).astype(object), val)
+            val = ts
+        return _CMP_OPS[op](s, val)
+    if op in ("in", "not in"):
+        vals = list(val) if isinstance(val, (list, tuple, set)) else [val]
+        if is_date:
+            vals = [_filter_date(v) if isinstance(v, str) else v for v in vals]
+            vals = [v for v in vals if v is not None]  # texto que no es fecha no coincide con ninguna
+        m = df[col].isin(vals)
+        return m if op == "in" else ~m
+    if op in _STR_OPS:
+        s = df[col].astype(str).str
+        if op == "contains":
+            return s.contains(str(val), case=False, na=False)
+        if op == "startswith":
+            return s.startswith(str(val), na=False)
+        return s.endswith(str(val), na=False)
+    return None
 
 
-# --- Parche anti base_url inválido (debe ir ANTES de crear el LLM) ---
-def _purge_openai_base_env():
-    """Elimina de este proceso cualquier OPENAI/AZURE base_url inválido (sin http/https)."""
-    removed = []
-    cand_keys = (
+def _order_filters_by_selectivity(df: pd.DataFrame, filters: List[dict], sample_rows: int = 2000) -> List[dict]:
+    # estima la fracción que pasa cada filtro sobre una muestra y aplica primero los más selectivos
+    if len(filters) < 2 or len(df) <= sample_rows:
+        return filters
+    # posiciones al azar (con reposición) en vez de df.sample: no baraja todo el índice,
+    # así el costo es O(sample_rows) aunque el frame tenga millones de filas
+    sample = df.iloc[np.random.default_rng(0).integers(0, len(df), sample_rows)]
+    scored = []
+    for i, f in enumerate(filters):
+        try:
+            m = _filter_mask(sample, f)
+            sel = float(m.mean()) if m is not None else 1.0
+        except Exception:
+            sel = 1.0  # que falle después con el error real, sobre el df completo
+        scored.append((sel, _OP_COST.get((f.get("operator") or "").lower(), 0), i, f))
+    return [f for *_, f in sorted(scored, key=lambda t: t[:3])]
+
+
+def execute_plan(plan: dict, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ejecuta un plan validado directamente sobre el DataFrame (máscaras + groupby/agg).
+    Mismo resultado y mismos nombres de columnas que el código de build_pandas_expr,
+    que queda solo para mostrar en generated.code.
+    """
+    op = (plan.get("operation") or "").lower()
+    group_by = plan.get("group_by") or []
+    target = plan.get("target")
+    filters = [f for f in (plan.get("filters") or []) if isinstance(f, dict)]
+
+    # ---- filtros: cada máscara se evalúa sobre las filas que sobrevivieron ----
+    base = df
+    for f in _order_filters_by_selectivity(df, filters):
+        m = _filter_mask(base, f)
+        if m is not None:
+            base = base.loc[m]
+
+    # float32 (optimize_dtypes) se agrega en float64 para no perder precisión en sum/mean
+    if target in base.columns and base[target].dtype == np.float32:
+        base = base.assign(**{target: base[target].astype("float64")})
+
+    # ---- sin group_by ----
+    if not group_by:
+        if op == "count":
+            return pd.DataFrame({"count": [len(base)]})
+        if not target:
+            raise ValueError("Falta 'target' para agregación sin group_by")
+        if op not in ("mean", "sum", "max", "min", "median"):
+            raise ValueError(f"Operación no soportada: {op}")
+        return pd.DataFrame({f"{op}_{target}": [getattr(base[target], op)()]})
+
+    # ---- con group_by ----
+    grouped = base.groupby(list(group_by), observed=True)  # categorías sin filas no aparecen
+    if op == "count" or not target:
+        return grouped.size().reset_index(name="count")
+    if op not in ("mean", "sum", "max", "min", "median"):
+        raise ValueError(f"Operación no soportada: {op}")
+    return getattr(grouped[target], op)().reset_index(name=f"{op}_{target}")
+
+
+# =========================
+# Ejecución por chunks (CSV más grandes que la memoria)
+# =========================
+CSV_STREAMING_MB = int(os.getenv("CSV_STREAMING_MB", "256"))
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "200000"))
+STREAM_MEDIAN_EXACT_MAX = int(os.getenv("STREAM_MEDIAN_EXACT_MAX", "2000000"))  # valores retenidos
+STREAM_MEDIAN_SAMPLE = int(os.getenv("STREAM_MEDIAN_SAMPLE", "20000"))         # por grupo
+
+
+def _csv_needs_streaming(path: str) -> bool:
+    try:
+        return path.lower().endswith(".csv") and os.path.getsize(path) > CSV_STREAMING_MB * 1024 * 1024
+    except OSError:
+        return False
+
+
+class _MedianSketch:
+    """
+    Mediana en streaming: guarda todos los valores mientras no pasen de exact_max (exacta);
+    luego cambia a bottom-k sampling (muestra uniforme de `sample` valores por grupo).
+    """
+
+    def __init__(self, group_by: List[str], exact_max: int, sample: int) -> None:
+        self.group_by = group_by
+        self.exact_max = exact_max
+        self.sample = sample
+        self.parts: List[pd.DataFrame] = []
+        self.kept = 0
+        self.exact = True
+        self._rng = np.random.default_rng()
+
+    def add(self, keys: Optional[pd.DataFrame], values: pd.Series) -> None:
+        part = pd.DataFrame({"__v": values.to_numpy()})
+        for c in self.group_by:
+            part[c] = keys[c].to_numpy()
+        part = part.dropna()
+        if self.exact:
+            self.parts.append(part)
+            self.kept += len(part)
+            if self.kept > self.exact_max:
+                self.exact = False
+                self.parts = [self._bottom_k(pd.concat(self.parts, ignore_index=True))]
+        else:
+            self.parts = [self._bottom_k(pd.concat(self.parts + [part], ignore_index=True))]
+
+    def _bottom_k(self, df: pd.DataFrame) -> pd.DataFrame:
+        # cada valor recibe una clave aleatoria una sola vez; las k menores por grupo = muestra uniforme
+        keys = (df["__k"] if "__k" in df else pd.Series(np.nan, index=df.index)).to_numpy(copy=True)
+        missing = np.isnan(keys)
+        keys[missing] = self._rng.random(int(missing.sum()))
+        df = df.assign(__k=keys).sort_values("__k")
+        if self.group_by:
+            return df.groupby(self.group_by, sort=False).head(self.sample)
+        return df.head(self.sample)
+
+    def result(self) -> Union[pd.Series, float]:
+        data = pd.concat(self.parts, ignore_index=True) if self.parts else pd.DataFrame({"__v": []})
+        if self.group_by:
+            return data.groupby(self.group_by)["__v"].median()
+        return float(data["__v"].median()) if len(data) else float("nan")
+
+
+def execute_plan_chunked(
+    plan: dict, path: str, chunk_rows: int = CSV_CHUNK_ROWS
+) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Ejecuta el plan leyendo el CSV por chunks: filtros por chunk + agregados parciales que
+    se combinan (sum/count/min/max; mean = sum/count). Memoria acotada por chunk y por
+    número de grupos. La mediana usa _MedianSketch (exacta o aproximada).
+    Devuelve (out, notices) con las mismas columnas que execute_plan.
+    """
+    op = (plan.get("operation") or "").lower()
+    group_by = list(plan.get("group_by") or [])
+    target = plan.get("target")
+    filters = [f for f in (plan.get("filters") or []) if isinstance(f, dict)]
+    if op not in ("count", "mean", "sum", "max", "min", "median"):
+        raise ValueError(f"Operación no soportada: {op}")
+    if op != "count" and not group_by and not target:
+        raise ValueError("Falta 'target' para agregación sin group_by")
+    counting = op == "count" or not target
+
+    needed = set(group_by) | {f.get("column") for f in filters}
+    if not counting:
+        needed.add(target)
+    usecols = [c for c in pd.read_csv(path, nrows=0).columns if c in needed] or None
+
+    acc: Optional[Any] = None     # parciales combinados
+    total_rows = 0                # count global
+    sketch = _MedianSketch(group_by, STREAM_MEDIAN_EXACT_MAX, STREAM_MEDIAN_SAMPLE) if op == "median" and not counting else None
+
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_rows):
+        for f in filters:
+            m = _filter_mask(chunk, f)
+            if m is not None:
+                chunk = chunk.loc[m]
+        if chunk.empty:
+            continue
+
+        if counting:
+            if group_by:
+                part = chunk.groupby(group_by).size()
+                acc = part if acc is None else acc.add(part, fill_value=0)
+            else:
+                total_rows += len(chunk)
+            continue
+
+        if sketch is not None:
+            sketch.add(chunk[group_by] if group_by else None, chunk[target])
+            continue
+
+        col = chunk[target]
+        if group_by:
+            part = col.groupby([chunk[c] for c in group_by]).agg(["sum", "count", "min", "max"])
+            if acc is None:
+                acc = part
+            else:
+                both = pd.concat([acc, part])
+                acc = both.groupby(level=list(range(both.index.nlevels))).agg(
+                    {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+                )
+        else:
+            stats = {"sum": col.sum(), "count": int(col.count()), "min": col.min(), "max": col.max()}
+            if acc is None:
+                acc = stats
+            else:
+                acc = {
+                    "sum": acc["sum"] + stats["sum"],
+                    "count": acc["count"] + stats["count"],
+                    "min": min(acc["min"], stats["min"]) if pd.notna(acc["min"]) else stats["min"],
+                    "max": max(acc["max"], stats["max"]) if pd.notna(acc["max"]) else stats["max"],
+                }
+
+    notices: List[str] = []
+    name = "count" if counting else f"{op}_{target}"
+
+    # ---- combinar ----
+    if counting:
+        if not group_by:
+            return pd.DataFrame({"count": [total_rows]}), notices
+        if acc is None:
+            return pd.DataFrame(columns=group_by + ["count"]), notices
+        return acc.astype("int64").reset_index(name="count"), notices
+
+    if sketch is not None:
+        if not sketch.exact:
+            notices.append(
+                f"Mediana aproximada (muestra uniforme de hasta {STREAM_MEDIAN_SAMPLE} valores por grupo)."
+            )
+        res = sketch.result()
+        if group_by:
+            return res.reset_index(name=name), notices
+        return pd.DataFrame({name: [res]}), notices
+
+    if group_by:
+        if acc is None:
+            return pd.DataFrame(columns=group_by + [name]), notices
+        if op == "mean":
+            series = acc["sum"] / acc["count"].where(acc["count"] > 0)
+        else:
+            series = acc[op]
+        return series.reset_index(name=name), notices
+
+    if acc is None:
+        value = 0 if op == "sum" else float("nan")
+    elif op == "mean":
+        value = acc["sum"] / acc["count"] if acc["count"] else float("nan")
+    else:
+        value = acc[op]
+    return pd.DataFrame({name: [value]}), notices
+
+
+# =========================
+# Modo aproximado (muestra + intervalos de confianza)
+# =========================
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", "100000"))
+_Z95 = 1.96
+
+# muestra uniforme por versión de archivo: se construye una vez y se reutiliza
+sample_cache = LRUCache(max_items=int(os.getenv("APPROX_SAMPLE_CACHE_MAX", "32")))
+
+
+def _csv_reservoir(path: str, k: int, rng: np.random.Generator) -> Tuple[pd.DataFrame, int]:
+    # reservoir por bottom-k: clave aleatoria por fila, se conservan las k menores
+    reservoir: Optional[pd.DataFrame] = None
+    total = 0
+    for chunk in pd.read_csv(path, chunksize=CSV_CHUNK_ROWS):
+        total += len(chunk)
+        chunk = chunk.assign(__k=rng.random(len(chunk)))
+        both = chunk if reservoir is None else pd.concat([reservoir, chunk], ignore_index=True)
+        reservoir = both.nsmallest(k, "__k")
+    sample = (reservoir if reservoir is not None else pd.DataFrame()).drop(columns="__k", errors="ignore")
+    return sample.reset_index(drop=True), total
+
+
+def _xlsx_reservoir(path: str, sheet_name: Union[int, str], k: int, rng: np.random.Generator) -> Tuple[pd.DataFrame, int]:
+    # openpyxl read-only fila a fila (algoritmo R): en memoria solo quedan k filas
+    columns = _workbook_sheet_meta(get_workbook_meta(path), sheet_name)["columns"]
+    rows: List[List[Any]] = []
+    total = 0
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = _xlsx_worksheet(wb, sheet_name)
+        for values in ws.iter_rows(min_row=2, values_only=True):
+            if all(v is None for v in values):
+                continue  # read_excel también descarta filas vacías
+            row = list(values[:len(columns)])
+            row += [None] * (len(columns) - len(row))
+            total += 1
+            if len(rows) < k:
+                rows.append(row)
+            else:
+                j = int(rng.integers(total))
+                if j < k:
+                    rows[j] = row
+    finally:
+        wb.close()
+    return pd.DataFrame(rows, columns=columns).infer_objects(), total
+
+
+def get_sample(path: str, sheet_name: Optional[Union[int, str]] = 0, k: int = APPROX_SAMPLE_ROWS) -> Tuple[pd.DataFrame, int]:
+    """
+    (muestra uniforme de hasta k filas, total de filas del archivo). Se muestrea durante la
+    lectura: nunca se carga la hoja completa salvo que ya esté en memoria.
+    """
+    st = os.stat(path)
+    key = json.dumps([os.path.abspath(path), str(sheet_name), st.st_mtime, st.st_size, k])
+    hit = sample_cache.get(key)
+    if hit is not None:
+        return hit
+
+    rng = np.random.default_rng()
+    df = df_cache.peek(path, sheet_name)
+    table = _read_columnar_table(path, sheet_name) if df is None else None
+    ext = os.path.splitext(path)[1].lower()
+    if df is not None:
+        # ya parseado por otra pregunta: muestrear en memoria es gratis
+        total = len(df)
+        sample = df if total <= k else df.sample(n=k).reset_index(drop=True)
+    elif table is not None:
+        # copia columnar (mmap): se materializan solo las filas elegidas
+        total = int(table.num_rows)
+        picks = np.sort(rng.choice(total, size=k, replace=False)) if total > k else np.arange(total)
+        sample = table.take(picks).to_pandas()
+    else:
+        if ext == ".csv":
+            sample, total = _csv_reservoir(path, k, rng)
+        elif ext == ".xlsx":
+            sample, total = _xlsx_reservoir(path, 0 if sheet_name is None else sheet_name, k, rng)
+        else:
+            # .xls: xlrd lee el libro entero igual; skiprows evita armar el DataFrame completo
+            total = int(_workbook_sheet_meta(get_workbook_meta(path), sheet_name)["rows"])
+            keep = set((rng.choice(total, size=k, replace=False) + 1).tolist()) if total > k else None
+            sample = pd.read_excel(
+                path, sheet_name=0 if sheet_name is None else sheet_name, engine="xlrd",
+                skiprows=(lambda i: i > 0 and i not in keep) if keep is not None else None,
+            )
+            total = total if keep is not None else len(sample)
+        sample = optimize_dtypes(sample, label=f"{os.path.basename(path)} (muestra)")
+
+    sample_cache.put(key, (sample, total))
+    return sample, total
+
+
+def execute_plan_approx(plan: dict, sample: pd.DataFrame, population: int) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Ejecuta el plan sobre la muestra y escala count/sum por N/n. Devuelve notices con
+    IC 95% (aprox. normal con corrección por población finita) para count/sum/mean.
+    """
+    op = (plan.get("operation") or "").lower()
+    group_by = list(plan.get("group_by") or [])
+    target = plan.get("target")
+    out = execute_plan(plan, sample)
+
+    n = len(sample)
+    scale = population / n if n else 0.0
+    fpc = max(0.0, 1.0 - n / population) if population else 0.0
+    counting = op == "count" or not target
+    col = out.columns[-1]
+
+    # filas que pasan los filtros (mismo criterio que execute_plan)
+    base = sample
+    for f in [f for f in (plan.get("filters") or []) if isinstance(f, dict)]:
+        m = _filter_mask(base, f)
+        if m is not None:
+            base = base.loc[m]
+
+    half: Optional[pd.Series] = None
+    if counting:
+        p = out[col].astype(float) / n
+        out[col] = (out[col] * scale).round().astype("int64")
+        half = _Z95 * population * np.sqrt(p * (1 - p) / n * fpc)
+    elif op in ("sum", "mean"):
+        x = base[target].astype(float)
+        if group_by:
+            keys = [base[c] for c in group_by]
+            g = x.groupby(keys, observed=True)
+            st = pd.DataFrame({"s": g.sum(), "q": (x ** 2).groupby(keys, observed=True).sum(),
+                               "m": g.count(), "sd": g.std()}).reset_index()
+            st = out[group_by].merge(st, on=group_by, how="left")
+        else:
+            st = pd.DataFrame({"s": [x.sum()], "q": [(x ** 2).sum()], "m": [x.count()], "sd": [x.std()]})
+        if op == "sum":
+            out[col] = out[col] * scale
+            # y_i = x_i si la fila pertenece al grupo/filtro, 0 si no (sobre las n filas)
+            var_y = (st["q"] / n - (st["s"] / n) ** 2) * n / max(n - 1, 1)
+            half = _Z95 * population * np.sqrt(var_y.clip(lower=0) / n * fpc)
+        else:
+            half = _Z95 * st["sd"] / np.sqrt(st["m"].where(st["m"] > 0)) * np.sqrt(fpc)
+
+    pct = 100.0 * n / population if population else 100.0
+    notices = [f"Respuesta aproximada: muestra de {n:,} de {population:,} filas ({pct:.1f}%)."]
+    if half is None:
+        notices.append(f"'{op}' se calcula sobre la muestra, sin escalar ni intervalo de confianza.")
+        return out, notices
+
+    labels = (
+        out[group_by].astype(str).agg("/".join, axis=1).tolist() if group_by else [col]
+    )
+    for i, (label, v, h) in enumerate(zip(labels, out[col].tolist(), list(half))):
+        if i >= 5:
+            notices.append(f"(+{len(labels) - 5} grupos más)")
+            break
+        if pd.notna(v) and pd.notna(h):
+            notices.append(f"{label}: {_fmt_num(v)} ± {_fmt_num(float(h))} (IC 95%)")
+    return out, notices
+
+
+# =========================
+# LLM
+# =========================
+# justo antes de crear el LLM
+
+
+# --- Parche anti base_url inválido (debe ir ANTES de crear el LLM) ---
+def _purge_openai_base_env():
+    """Elimina de este proceso cualquier OPENAI/AZURE base_url inválido (sin http/https)."""
+    removed = []
+    cand_keys = (
         "OPENAI_API_BASE",
         "OPENAI_BASE_URL",
         "OPENAI_BASE",  # por si acaso
@@ -1073,9 +2649,34 @@ if not (
 ):
     _OPENAI_BASE = None
 
+# ========= Gateway LLM =========
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))              # deadline por intento (s)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # llamadas simultáneas al proveedor
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))                  # reintentos ante errores transitorios
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_KEEPALIVE = int(os.getenv("LLM_KEEPALIVE", "20"))             # conexiones keep-alive por cliente
+# hedging: si la respuesta tarda más que el p95 observado, se lanza una segunda solicitud
+# (a LLM_FALLBACK_MODEL si está definido) y gana la primera que responda
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))             # > 0: espera fija (s) en vez del p95
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "3"))  # hasta juntar muestras
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))  # fracción máx. de llamadas con cobertura
+
+# clientes HTTP compartidos: conexiones keep-alive reutilizadas entre llamadas
+_llm_limits = httpx.Limits(
+    max_connections=max(LLM_MAX_CONCURRENCY, LLM_KEEPALIVE), max_keepalive_connections=LLM_KEEPALIVE,
+    keepalive_expiry=60,
+)
 _llm_kwargs = dict(
     model=os.getenv("LLM_MODEL", "gpt-4.1-mini"),
     temperature=0,
+    timeout=LLM_TIMEOUT,
+    max_retries=0,  # los reintentos los hace el gateway (si no, se multiplican)
+    http_client=httpx.Client(limits=_llm_limits, timeout=LLM_TIMEOUT),
+    http_async_client=httpx.AsyncClient(limits=_llm_limits, timeout=LLM_TIMEOUT),
 )
 if _OPENAI_BASE:
     _llm_kwargs["base_url"] = _OPENAI_BASE  # SOLO si es válido
@@ -1083,6 +2684,236 @@ if _OPENAI_BASE:
 llm = ChatOpenAI(**_llm_kwargs)
 parser = StrOutputParser()
 
+# modelo alternativo (más rápido/barato) para las solicitudes de cobertura (hedge); opcional
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "").strip()
+llm_fallback = ChatOpenAI(**{**_llm_kwargs, "model": LLM_FALLBACK_MODEL}) if LLM_FALLBACK_MODEL else None
+
+
+def _text_chain(model):
+    return model | parser
+
+_LLM_TRANSIENT = (
+    openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError,
+    httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError, TimeoutError,
+)
+
+
+class LLMUnavailable(HTTPException):
+    """El proveedor LLM no responde (circuito abierto, saturado o reintentos agotados)."""
+
+    def __init__(self, detail: str) -> None:
+        super().__init__(status_code=503, detail=detail)
+
+
+class LLMGateway:
+    """
+    Toda llamada al LLM pasa por acá:
+    - semáforo de concurrencia (LLM_MAX_CONCURRENCY); esperar más de LLM_TIMEOUT por un lugar → 503
+    - deadline por intento (LLM_TIMEOUT) y reintentos con backoff exponencial + jitter
+      solo para errores transitorios (timeouts, conexión, 429, 5xx)
+    - circuit breaker: tras LLM_BREAKER_FAILURES fallos transitorios seguidos se abre por
+      LLM_BREAKER_COOLDOWN s y las llamadas fallan al instante con LLMUnavailable; luego
+      deja pasar una llamada de prueba (half-open) que lo cierra o lo vuelve a abrir.
+    - hedging (con LLM_HEDGE=1): pasado el percentil de latencia observado
+      se lanza una segunda solicitud; gana la primera y la otra se cancela. Como mucho
+      LLM_HEDGE_MAX_RATE de las llamadas llevan cobertura, así una degradación general del
+      proveedor no duplica la carga.
+    Las llamadas reciben build(model) → Runnable, para poder armar la misma cadena sobre
+    el modelo de cobertura.
+    """
+
+    def __init__(self, max_concurrency: int, timeout: float, retries: int,
+                 breaker_failures: int, breaker_cooldown: float, hedge: bool = False) -> None:
+        self.timeout = timeout
+        self.hedge = hedge
+        self._latencies: "deque[float]" = deque(maxlen=500)
+        self.hedge_calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedge_capped = 0
+        self.retries = retries
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self._asem = asyncio.Semaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+
+    # --- circuit breaker ---
+    def _before_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+            if self.state == "open":
+                if time() - self.opened_at < self.breaker_cooldown:
+                    self.rejected += 1
+                    raise LLMUnavailable("LLM no disponible temporalmente (circuito abierto)")
+                self.state = "half_open"  # esta llamada es la de prueba
+            elif self.state == "half_open":
+                self.rejected += 1
+                raise LLMUnavailable("LLM no disponible temporalmente (probando recuperación)")
+
+    def _after_call(self, error: Optional[BaseException]) -> None:
+        with self._lock:
+            if error is None or not isinstance(error, _LLM_TRANSIENT):
+                # el proveedor respondió (aunque sea con un error propio de la request)
+                self.state = "closed"
+                self.failures = 0
+                if error is not None:
+                    self.errors += 1
+                return
+            self.errors += 1
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.breaker_failures:
+                if self.state != "open":
+                    print(f"[llm] circuito abierto tras {self.failures} fallo(s): {error!r}")
+                self.state = "open"
+                self.opened_at = time()
+
+    def _abort_call(self, rejected: bool = True) -> None:
+        # sin respuesta del proveedor (rechazada o cancelada): si era la llamada de prueba,
+        # el circuito vuelve a open y la próxima llamada tras el cooldown prueba otra vez
+        with self._lock:
+            if rejected:
+                self.rejected += 1
+            if self.state == "half_open":
+                self.state = "open"
+
+    def _retry_kw(self) -> Dict[str, Any]:
+        return dict(
+            stop=stop_after_attempt(self.retries + 1),
+            wait=wait_random_exponential(multiplier=0.5, max=8),
+            retry=retry_if_exception(lambda e: isinstance(e, _LLM_TRANSIENT)),
+            reraise=True,
+        )
+
+    # --- hedging ---
+    def hedge_delay(self) -> float:
+        if LLM_HEDGE_DELAY > 0:
+            return LLM_HEDGE_DELAY
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_INITIAL_DELAY
+        idx = min(len(samples) - 1, int(math.ceil(LLM_HEDGE_PERCENTILE / 100 * len(samples))) - 1)
+        return samples[idx]
+
+    def _record_primary(self, started: float, task: "asyncio.Future[Any]") -> None:
+        # toda solicitud principal deja muestra: si la cancelamos (ganó la cobertura o venció
+        # el deadline) el tiempo transcurrido es una cota inferior; sin esto el p95 solo vería
+        # las respuestas rápidas y la espera para cubrir se iría achicando sola.
+        # Las que fallan no cuentan: un error inmediato no es latencia del modelo.
+        if task.cancelled() or task.exception() is None:
+            with self._lock:
+                self._latencies.append(time() - started)
+
+    def _may_hedge(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > LLM_HEDGE_MAX_RATE * self.hedge_calls:
+                self.hedge_capped += 1
+                return False
+            self.hedged += 1
+            return True
+
+    async def _call_hedged(self, build: Callable[[Any], Any], inp: Any) -> Any:
+        started = time()
+        primary = asyncio.ensure_future(build(llm).ainvoke(inp))
+        primary.add_done_callback(lambda t: self._record_primary(started, t))
+        with self._lock:
+            self.hedge_calls += 1
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if not done and self._may_hedge():
+                hedge_model = llm_fallback if llm_fallback is not None else llm
+                tasks.add(asyncio.ensure_future(build(hedge_model).ainvoke(inp)))
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is not primary:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return t.result()
+                    error = t.exception()
+            raise error
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()  # la solicitud perdedora no sigue ocupando conexión
+
+    @staticmethod
+    def _wrap(error: BaseException) -> BaseException:
+        if isinstance(error, _LLM_TRANSIENT):
+            return LLMUnavailable(f"LLM no respondió a tiempo: {error!r}")
+        return error
+
+    # --- llamadas ---
+    async def ainvoke(self, build: Callable[[Any], Any], inp: Any) -> Any:
+        self._before_call()
+        try:
+            await asyncio.wait_for(self._asem.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._abort_call()
+            raise LLMUnavailable("LLM saturado: demasiadas solicitudes en curso")
+        except BaseException:
+            self._abort_call(rejected=False)  # cancelada esperando lugar
+            raise
+        try:
+            async for attempt in AsyncRetrying(**self._retry_kw()):
+                with attempt:
+                    call = self._call_hedged(build, inp) if self.hedge else build(llm).ainvoke(inp)
+                    result = await asyncio.wait_for(call, timeout=self.timeout)
+        except Exception as e:
+            self._after_call(e)
+            raise self._wrap(e) from e
+        except BaseException:
+            # CancelledError (cliente desconectado, hedge, shutdown): no dice nada del proveedor,
+            # pero una llamada de prueba no puede dejar el circuito en half_open para siempre
+            self._abort_call(rejected=False)
+            raise
+        finally:
+            self._asem.release()
+        self._after_call(None)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "calls": self.calls,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "max_concurrency": self.max_concurrency,
+                "timeout": self.timeout,
+                "retries": self.retries,
+                "hedge": self.hedge,
+                "hedge_fallback_model": LLM_FALLBACK_MODEL or None,
+                "hedge_max_rate": LLM_HEDGE_MAX_RATE,
+                "hedge_calls": self.hedge_calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "hedge_capped": self.hedge_capped,
+                "latency_samples": len(self._latencies),
+            }
+
+
+llm_gateway = LLMGateway(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    retries=LLM_RETRIES,
+    breaker_failures=LLM_BREAKER_FAILURES,
+    breaker_cooldown=LLM_BREAKER_COOLDOWN,
+    hedge=LLM_HEDGE,
+)
+
 # DEBUG: imprime qué base_url terminó usando el cliente
 try:
     print("DEBUG llm.client.base_url =", getattr(llm.client, "base_url", None))
@@ -1330,6 +3161,8 @@ DataSource = Annotated[
 class ChatOptions(BaseModel):
     language: Literal["es", "en"] = "es"
     max_rows: int = 200
+    mode: Literal["exact", "approx"] = "exact"  # approx: Excel/CSV sobre una muestra con IC 95%
+    excel_engine: Literal["pandas", "sqlite"] = "pandas"  # sqlite: Excel/CSV vía tabla indexada + sql_stages
 
 
 class ChatRequest(BaseModel):
@@ -1486,39 +3319,305 @@ def _detect_lang(question: str, preferred: str | None = None) -> str:
 # =========================
 
 
-def extract_sql_schema_from_engine(engine: Engine, max_cols: int = 80, max_tables: int = 50) -> Dict[str, List[str]]:
+SCHEMA_MAX_TABLES = int(os.getenv("SCHEMA_MAX_TABLES", "300"))
+
+# Reflexión en bloque: 1 sola consulta devuelve (tabla, columna, tipo, fk_tabla, fk_columna)
+_BULK_SCHEMA_SQL = {
+    "mysql": """
+        SELECT c.table_name, c.column_name, c.data_type, k.referenced_table_name, k.referenced_column_name
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+          ON t.table_schema = c.table_schema AND t.table_name = c.table_name AND t.table_type = 'BASE TABLE'
+        LEFT JOIN information_schema.key_column_usage k
+          ON k.table_schema = c.table_schema AND k.table_name = c.table_name
+         AND k.column_name = c.column_name AND k.referenced_table_name IS NOT NULL
+        WHERE c.table_schema = DATABASE()
+        ORDER BY c.table_name, c.ordinal_position
+    """,
+    "postgres": """
+        SELECT c.table_name, c.column_name, c.data_type, fk.ref_table, fk.ref_column
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+          ON t.table_schema = c.table_schema AND t.table_name = c.table_name AND t.table_type = 'BASE TABLE'
+        LEFT JOIN (
+            SELECT kcu.table_schema, kcu.table_name, kcu.column_name,
+                   ccu.table_name AS ref_table, ccu.column_name AS ref_column
+            FROM information_schema.table_constraints tc
+            JOIN information_schema.key_column_usage kcu
+              ON kcu.constraint_name = tc.constraint_name AND kcu.constraint_schema = tc.constraint_schema
+            JOIN information_schema.constraint_column_usage ccu
+              ON ccu.constraint_name = tc.constraint_name AND ccu.constraint_schema = tc.constraint_schema
+            WHERE tc.constraint_type = 'FOREIGN KEY'
+        ) fk ON fk.table_schema = c.table_schema AND fk.table_name = c.table_name AND fk.column_name = c.column_name
+        WHERE c.table_schema = current_schema()
+        ORDER BY c.table_name, c.ordinal_position
+    """,
+    "sqlite": """
+        SELECT m.name, p.name, p.type, f."table", f."to"
+        FROM sqlite_master m
+        JOIN pragma_table_info(m.name) p
+        LEFT JOIN pragma_foreign_key_list(m.name) f ON f."from" = p.name
+        WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+        ORDER BY m.name, p.cid
+    """,
+}
+
+
+def _reflect_sql_schema_bulk(engine: Engine) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Un solo round trip por dialecto conocido. None si no hay ruta bulk o falla."""
+    sql = _BULK_SCHEMA_SQL.get(_dialect_from_url(str(engine.url)))
+    if not sql:
+        return None
+    try:
+        with engine.connect() as c:
+            rows = c.execute(text(sql)).fetchall()
+    except SQLAlchemyError as e:
+        print("WARN: reflexión bulk falló, usando Inspector:", e)
+        return None
+
+    out: Dict[str, Dict[str, Any]] = {}
+    for table, col, col_type, ref_table, ref_col in rows:
+        t = out.setdefault(str(table), {"columns": [], "foreign_keys": []})
+        if not t["columns"] or t["columns"][-1]["name"] != col:
+            t["columns"].append({"name": str(col), "type": str(col_type or "")})
+        if ref_table:
+            t["foreign_keys"].append({"column": str(col), "ref_table": str(ref_table), "ref_column": ref_col})
+    return out
+
+
+def _reflect_sql_schema_inspector(engine: Engine, max_tables: int) -> Dict[str, Dict[str, Any]]:
+    # Fallback para dialectos desconocidos (N+1 round trips)
     insp = inspect(engine)
-    schema: Dict[str, List[str]] = {}
+    out: Dict[str, Dict[str, Any]] = {}
     for t in insp.get_table_names()[:max_tables]:
         try:
-            cols = [c["name"] for c in insp.get_columns(t)][:max_cols]
-            schema[t] = cols
+            cols = [{"name": c["name"], "type": str(c["type"])} for c in insp.get_columns(t)]
+            out[t] = {"columns": cols, "foreign_keys": []}
         except Exception:
             continue
-    return schema
+    return out
+
+
+def reflect_sql_schema(engine: Engine, max_tables: int = SCHEMA_MAX_TABLES) -> Dict[str, Dict[str, Any]]:
+    """
+    Devuelve {tabla: {"columns": [{"name", "type"}], "foreign_keys": [{"column", "ref_table", "ref_column"}]}}.
+    Usa la ruta bulk del dialecto (1 consulta) y cae al Inspector si no existe.
+    """
+    details = _reflect_sql_schema_bulk(engine)
+    if details is None:
+        return _reflect_sql_schema_inspector(engine, max_tables)
+    return dict(list(details.items())[:max_tables])
+
+
+def _schema_column_names(details: Dict[str, Dict[str, Any]], max_cols: int = 80) -> Dict[str, List[str]]:
+    # formato compacto que va al prompt: {tabla: [columnas]}
+    return {t: [c["name"] for c in d["columns"]][:max_cols] for t, d in details.items()}
+
+
+def extract_sql_schema_from_engine(
+    engine: Engine, max_cols: int = 80, max_tables: int = SCHEMA_MAX_TABLES
+) -> Dict[str, List[str]]:
+    return _schema_column_names(reflect_sql_schema(engine, max_tables=max_tables), max_cols=max_cols)
+
+
+# Consultas baratas (1 round trip) que cambian cuando cambia el esquema
+_SCHEMA_FINGERPRINT_SQL = {
+    "mysql": (
+        "SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT(table_name, '.', column_name, ':', data_type))), 0)) "
+        "FROM information_schema.columns WHERE table_schema = DATABASE()"
+    ),
+    "postgres": (
+        "SELECT md5(COALESCE(string_agg(table_name || '.' || column_name || ':' || data_type, ',' "
+        "ORDER BY table_name, ordinal_position), '')) "
+        "FROM information_schema.columns WHERE table_schema = current_schema()"
+    ),
+    "sqlite": "PRAGMA schema_version",
+}
+
+
+def _schema_fingerprint(engine: Engine) -> Optional[str]:
+    """Devuelve un fingerprint del esquema, o None si el dialecto no lo soporta / falla."""
+    sql = _SCHEMA_FINGERPRINT_SQL.get(_dialect_from_url(str(engine.url)))
+    if not sql:
+        return None
+    try:
+        with engine.connect() as c:
+            row = c.execute(text(sql)).fetchone()
+        return str(row[0]) if row else None
+    except SQLAlchemyError as e:
+        print("WARN: no se pudo calcular fingerprint de esquema:", e)
+        return None
+
+
+SCHEMA_CACHE_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "300"))  # 5 mins
+
+
+class SchemaCache:
+    """
+    Cache de esquemas SQL reflejados, keyed por datasource ('conn:3' o URL).
+    - Dentro del TTL: 0 round trips.
+    - Vencido el TTL: 1 round trip (fingerprint); solo si cambió se vuelve a reflejar.
+    """
+
+    def __init__(self, ttl_seconds: int = 300) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.reflections = 0
+
+    def _load(self, key: str, engine: Engine, fingerprint: Optional[str]) -> Dict[str, Any]:
+        details = reflect_sql_schema(engine)
+        schema = _schema_column_names(details)
+        now = time()
+        entry = {
+            "schema": schema,
+            "details": details,
+            "fingerprint": fingerprint,
+            "schema_hash": hashlib.sha1(
+                json.dumps(schema, sort_keys=True, ensure_ascii=False).encode("utf-8")
+            ).hexdigest(),
+            "loaded_at": now,
+            "checked_at": now,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self.reflections += 1
+        return entry
+
+    def get(self, key: str, engine: Engine) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (time() - entry["checked_at"]) < self.ttl_seconds:
+                self.hits += 1
+                return entry
+
+        fingerprint = _schema_fingerprint(engine)
+        if entry is not None and fingerprint is not None and fingerprint == entry["fingerprint"]:
+            with self._lock:
+                entry["checked_at"] = time()
+                self.revalidations += 1
+            return entry
+        return self._load(key, engine, fingerprint)
+
+    def refresh(self, key: str, engine: Engine) -> Dict[str, Any]:
+        return self._load(key, engine, _schema_fingerprint(engine))
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        with self._lock:
+            if key is None:
+                n = len(self._entries)
+                self._entries.clear()
+                return n
+            return 1 if self._entries.pop(key, None) is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "reflections": self.reflections,
+                "items": [
+                    {
+                        "key": k if k.startswith("conn:") else "url:" + e["schema_hash"][:8],
+                        "tables": len(e["schema"]),
+                        "fingerprint": e["fingerprint"],
+                        "loaded_at": int(e["loaded_at"]),
+                        "checked_at": int(e["checked_at"]),
+                    }
+                    for k, e in self._entries.items()
+                ],
+            }
+
+
+schema_cache = SchemaCache(ttl_seconds=SCHEMA_CACHE_TTL)
+
+
+@app.get("/admin/schema-cache")
+def admin_schema_cache_stats(_: dict = Depends(require_roles(["admin"]))):
+    return schema_cache.stats()
+
+
+@app.delete("/admin/schema-cache")
+def admin_schema_cache_clear(admin=Depends(require_roles(["admin"]))):
+    cleared = schema_cache.invalidate()
+    log_event("info", "schema_cache_clear", actor=admin["email"], path="/admin/schema-cache", meta={"cleared": cleared})
+    return {"cleared": cleared}
+
+
+@app.post("/admin/connections/{conn_id}/schema/refresh")
+def admin_refresh_connection_schema(
+    conn_id: int,
+    admin=Depends(require_roles(["admin"])),
+    db: Session = Depends(get_db),
+):
+    conn = db.get(Connection, conn_id)
+    if not conn:
+        raise HTTPException(status_code=404, detail="Conexión no encontrada")
+    key = f"conn:{conn.id}"
+    try:
+        entry = schema_cache.refresh(key, engine_registry.get(conn.sqlalchemy_url, key=key))
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=400, detail=f"No se pudo leer el esquema: {e}")
+    log_event("info", "schema_refresh", actor=admin["email"], path=f"/admin/connections/{conn_id}/schema/refresh",
+              meta={"id": conn.id, "tables": len(entry["schema"])})
+    return {"ok": True, "id": conn.id, "tables": len(entry["schema"]), "fingerprint": entry["fingerprint"]}
+
+
+@app.get("/admin/sql-cache")
+def admin_sql_cache_stats(_: dict = Depends(require_roles(["admin"]))):
+    return sql_gen_cache.stats()
+
+
+@app.delete("/admin/sql-cache")
+def admin_sql_cache_purge(
+    connection_id: Optional[int] = Query(None, description="Solo las entradas de esta conexión guardada"),
+    admin=Depends(require_roles(["admin"])),
+):
+    ds_key = f"conn:{connection_id}" if connection_id is not None else None
+    deleted = sql_gen_cache.purge(ds_key=ds_key)
+    log_event("info", "sql_cache_purge", actor=admin["email"], path="/admin/sql-cache",
+              meta={"connection_id": connection_id, "deleted": deleted})
+    return {"deleted": deleted}
 
 
 def extract_excel_schema(
-    path: str, sheet_name: Optional[Union[int, str]] = 0, sample_rows: int = 2000
+    path: Union[str, pd.DataFrame], sheet_name: Optional[Union[int, str]] = 0, sample_rows: int = 2000
 ) -> Dict[str, Any]:
-    if path.lower().endswith(".csv"):
-        df = pd.read_csv(path, nrows=sample_rows)
+    """Columnas y dtypes. Acepta una ruta o un DataFrame ya cargado (no se relee el archivo)."""
+    if isinstance(path, pd.DataFrame):
+        df = path
     else:
-        df = pd.read_excel(path, sheet_name=sheet_name, nrows=sample_rows)
+        # dtypes registrados en la ingesta columnar: no se abre ningún archivo de datos
+        meta = _columnar_meta(path)
+        sh = _columnar_sheet(meta, sheet_name) if meta else None
+        if sh:
+            return {"columns": sh["columns"], "dtypes": sh["dtypes"]}
+        # si el archivo ya está parseado en memoria, no se vuelve a abrir
+        df = df_cache.peek(path, sheet_name)
+        if df is not None:
+            df = df.head(sample_rows)
+        elif path.lower().endswith(".csv"):
+            df = pd.read_csv(path, nrows=sample_rows)
+        else:
+            df = pd.read_excel(path, sheet_name=sheet_name, nrows=sample_rows)
     return {
         "columns": list(df.columns),
         "dtypes": {c: str(df[c].dtype) for c in df.columns},
     }
 
-def _make_engine(sqlalchemy_url: str) -> Engine:
+def _make_engine(sqlalchemy_url: str, **pool_kw: Any) -> Engine:
     url_l = sqlalchemy_url.lower()
     if url_l.startswith("mysql"):
-        return create_engine(sqlalchemy_url, connect_args={"charset": "utf8mb4"}, pool_pre_ping=True)
+        return create_engine(sqlalchemy_url, connect_args={"charset": "utf8mb4"}, pool_pre_ping=True, **pool_kw)
     if url_l.startswith("sqlite"):
-        # Para SQLite en archivo local
+        # Para SQLite en archivo local (el pool de SQLite no acepta knobs de tamaño)
         return create_engine(sqlalchemy_url, connect_args={"check_same_thread": False})
     # postgres, etc.
-    return create_engine(sqlalchemy_url, pool_pre_ping=True)
+    return create_engine(sqlalchemy_url, pool_pre_ping=True, **pool_kw)
 
 def _dialect_from_url(sqlalchemy_url: str) -> str:
     url_l = sqlalchemy_url.lower()
@@ -1531,6 +3630,157 @@ def _dialect_from_url(sqlalchemy_url: str) -> str:
     # por defecto intenta ANSI SQL
     return "ansi"
 
+# ========= EngineRegistry =========
+# Un Engine por datasource para todo el proceso: evita handshake TCP/TLS + auth
+# en cada /chat y deja que el pool se mantenga caliente.
+ENGINE_REGISTRY_MAX = int(os.getenv("ENGINE_REGISTRY_MAX", "16"))
+ENGINE_IDLE_SECONDS = int(os.getenv("ENGINE_IDLE_SECONDS", "900"))  # 15 mins
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "5"))
+SQL_MAX_OVERFLOW = int(os.getenv("SQL_MAX_OVERFLOW", "10"))
+SQL_POOL_TIMEOUT = int(os.getenv("SQL_POOL_TIMEOUT", "30"))
+SQL_POOL_RECYCLE = int(os.getenv("SQL_POOL_RECYCLE", "1800"))
+
+
+class EngineRegistry:
+    """
+    Registro LRU de Engines keyed por URL (o por clave explícita, ej. 'conn:3').
+    - Tamaño acotado (max_engines): al pasarse, se hace dispose del menos usado.
+    - Los engines sin uso por más de idle_seconds se cierran en reap_idle().
+    """
+
+    def __init__(self, max_engines: int = 16, idle_seconds: int = 900, **pool_defaults: Any) -> None:
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.pool_defaults = pool_defaults
+        self._engines: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sqlalchemy_url: str, *, key: Optional[str] = None, **pool_kw: Any) -> Engine:
+        k = key or sqlalchemy_url
+        with self._lock:
+            entry = self._engines.get(k)
+            if entry is not None and entry["url"] == sqlalchemy_url:
+                self._engines.move_to_end(k)
+                entry["last_used"] = time()
+                entry["uses"] += 1
+                self.hits += 1
+                return entry["engine"]
+            if entry is not None:
+                # misma clave pero la URL cambió → descarta el viejo
+                self._engines.pop(k)
+                entry["engine"].dispose()
+
+            self.misses += 1
+            eng = _make_engine(sqlalchemy_url, **{**self.pool_defaults, **pool_kw})
+            self._engines[k] = {
+                "engine": eng,
+                "url": sqlalchemy_url,
+                "created_at": time(),
+                "last_used": time(),
+                "uses": 1,
+            }
+            while len(self._engines) > self.max_engines:
+                _, old = self._engines.popitem(last=False)
+                old["engine"].dispose()
+                self.evictions += 1
+            return eng
+
+    def discard(self, key: str) -> bool:
+        with self._lock:
+            entry = self._engines.pop(key, None)
+        if entry is None:
+            return False
+        entry["engine"].dispose()
+        return True
+
+    def reap_idle(self) -> int:
+        now = time()
+        with self._lock:
+            stale = [k for k, e in self._engines.items() if (now - e["last_used"]) >= self.idle_seconds]
+            entries = [self._engines.pop(k) for k in stale]
+        for e in entries:
+            e["engine"].dispose()
+        self.evictions += len(entries)
+        return len(entries)
+
+    def clear(self) -> int:
+        with self._lock:
+            entries = list(self._engines.values())
+            self._engines.clear()
+        for e in entries:
+            e["engine"].dispose()
+        return len(entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            items = []
+            for k, e in self._engines.items():
+                eng: Engine = e["engine"]
+                pool = eng.pool
+                items.append({
+                    "key": k if k != e["url"] else eng.url.render_as_string(hide_password=True),
+                    "url": eng.url.render_as_string(hide_password=True),
+                    "dialect": _dialect_from_url(e["url"]),
+                    "uses": e["uses"],
+                    "created_at": int(e["created_at"]),
+                    "last_used": int(e["last_used"]),
+                    "pool": pool.status(),
+                    "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                })
+            return {
+                "size": len(self._engines),
+                "max_engines": self.max_engines,
+                "idle_seconds": self.idle_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "items": items,
+            }
+
+
+engine_registry = EngineRegistry(
+    max_engines=ENGINE_REGISTRY_MAX,
+    idle_seconds=ENGINE_IDLE_SECONDS,
+    pool_size=SQL_POOL_SIZE,
+    max_overflow=SQL_MAX_OVERFLOW,
+    pool_timeout=SQL_POOL_TIMEOUT,
+    pool_recycle=SQL_POOL_RECYCLE,
+)
+
+
+@app.on_event("startup")
+async def _engine_reaper_start():
+    async def _reaper():
+        while True:
+            try:
+                n = engine_registry.reap_idle()
+                if n:
+                    print(f"[engines] {n} engine(s) inactivos cerrados")
+            except Exception as e:
+                print("WARN engine reaper:", e)
+            await asyncio.sleep(60)  # corre cada 60s
+    asyncio.create_task(_reaper())
+
+
+@app.on_event("shutdown")
+def _engine_registry_shutdown():
+    engine_registry.clear()
+
+
+@app.get("/admin/engines")
+def admin_engine_stats(_: dict = Depends(require_roles(["admin"]))):
+    return engine_registry.stats()
+
+
+@app.delete("/admin/engines")
+def admin_engine_clear(admin=Depends(require_roles(["admin"]))):
+    disposed = engine_registry.clear()
+    log_event("warning", "engines_clear", actor=admin["email"], path="/admin/engines", meta={"disposed": disposed})
+    return {"disposed": disposed}
+
 # =========================
 # Prompting (few-shots mínimos; ajústalos a tu esquema real)
 # =========================
@@ -1785,102 +4035,618 @@ def exec_pandas(code: str, df: pd.DataFrame) -> pd.DataFrame:
 # =========================
 
 
-def answer_sql(question: str, sqlalchemy_url: str, opts: ChatOptions) -> ChatResponse:
+def _sql_prepare(
+    question: str, sqlalchemy_url: str, opts: ChatOptions, conn_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """Esquema y SQL cacheado; si no hay cache, ctx["prompt"] es lo que hay que pedirle al LLM."""
     dialect = _dialect_from_url(sqlalchemy_url)
-    engine = _make_engine(sqlalchemy_url)
+    engine = engine_registry.get(sqlalchemy_url, key=conn_key)
+
+    # 1) esquema (cacheado por datasource; se revalida por fingerprint)
+    schema_entry = schema_cache.get(conn_key or sqlalchemy_url, engine)
+    schema = schema_entry["schema"]
+
+    # 2) SQL: cache por (datasource, esquema, dialecto, pregunta normalizada, max_rows) o LLM
+    ds_key = conn_key or "url:" + hashlib.sha1(sqlalchemy_url.encode("utf-8")).hexdigest()
+    question_norm = _normalize_question(question)
+    cache_key = SqlGenCache.make_key(
+        ds_key=ds_key, schema_hash=schema_entry["schema_hash"], dialect=dialect,
+        question_norm=question_norm, max_rows=opts.max_rows,
+    )
+    sql_code = sql_gen_cache.get(cache_key)
+    ctx = {
+        "engine": engine, "dialect": dialect, "schema": schema, "ds_key": ds_key,
+        "question_norm": question_norm, "cache_key": cache_key,
+        "sql": sql_code, "from_cache": sql_code is not None, "prompt": None,
+    }
+    if sql_code is None:
+        ctx["prompt"] = SQL_PROMPT.format_messages(
+            schema=json.dumps(schema, ensure_ascii=False),
+            question=question,
+            dialect=dialect,
+        )
+    return ctx
 
-    # 1) esquema
-    try:
-        schema = extract_sql_schema_from_engine(engine)
-    finally:
-        # no cierres aún; lo usamos para ejecutar
-        pass
 
-    # 2) prompt (incluye dialect)
-    prompt = SQL_PROMPT.format_messages(
-        schema=json.dumps(schema, ensure_ascii=False),
-        question=question,
-        dialect=dialect,
-    )
-    sql_code = (llm | parser).invoke(prompt)
-    sql_code = sanitize_sql(sql_code, limit=opts.max_rows)
+def _frame_rows(df: pd.DataFrame) -> List[List[Any]]:
+    return df.astype(object).where(pd.notnull(df), None).values.tolist()
 
-    # 3) ejecutar
+
+def _dates_as_text(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Columnas datetime64 sin hora → texto AAAA-MM-DD para mostrar (preview, filas de /chat):
+    una columna de fechas ISO convertida por optimize_dtypes se ve igual que en el archivo.
+    """
+    dates = [
+        c for c in df.columns
+        if pd.api.types.is_datetime64_any_dtype(df[c].dtype) and (df[c].dropna().dt.normalize() == df[c].dropna()).all()
+    ]
+    if not dates:
+        return df
+    df = df.copy()
+    for c in dates:
+        df[c] = df[c].dt.strftime(_ISO_DATE_FMT).astype(object)
+    return df
+
+
+def _sql_error(e: SQLAlchemyError, sql_code: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"Error SQL: {str(e)} | Query: {sql_code}")
+
+
+def _sql_open(ctx: Dict[str, Any]) -> Tuple[Any, Any]:
+    """(conexión, cursor) con la query ya ejecutada; quien llama cierra la conexión."""
+    conn = ctx["engine"].connect()
     try:
-        with engine.connect() as conn:
-            res = conn.execute(text(sql_code))
-            rows = res.fetchall()
-            cols = list(res.keys())
+        return conn, conn.execute(text(ctx["sql"]))
     except SQLAlchemyError as e:
-        raise HTTPException(status_code=400, detail=f"Error SQL: {str(e)} | Query: {sql_code}")
-    finally:
-        engine.dispose()
+        conn.close()
+        raise _sql_error(e, ctx["sql"])
+    except BaseException:
+        conn.close()
+        raise
 
-    df = pd.DataFrame(rows, columns=cols)
-    table = TableData(
-        columns=cols, rows=df.astype(object).where(pd.notnull(df), None).values.tolist()
-    )
+
+def _sql_response(ctx: Dict[str, Any], question: str, opts: ChatOptions,
+                  cols: List[str], rows: List[List[Any]]) -> ChatResponse:
+    sql_code = ctx["sql"]
+    # solo se cachea SQL que ejecutó bien
+    if not ctx["from_cache"]:
+        try:
+            sql_gen_cache.put(ctx["cache_key"], sql_code, ds_key=ctx["ds_key"], dialect=ctx["dialect"],
+                              question_norm=ctx["question_norm"], max_rows=opts.max_rows)
+        except Exception as e:
+            print("WARN: no se pudo guardar en cache SQL:", e)
+
+    table = TableData(columns=cols, rows=rows)
     lang = _detect_lang(question, getattr(opts, "language", None))
     answer_text = make_answer_text(
-        {"columns": cols, "rows": table.rows, "total": len(df)},
+        {"columns": cols, "rows": table.rows, "total": len(rows)},
         lang=opts.language,
         question=question,
     )
+    notices = []
+    if opts.mode == "approx":
+        notices.append("El modo aproximado solo aplica a Excel/CSV; esta respuesta SQL es exacta.")
     return ChatResponse(
         answer_text=answer_text,
         generated={"type": "sql", "code": sql_code},
         table=table,
-        notices=[],
+        notices=notices,
     )
 
 
+def _sql_execute(ctx: Dict[str, Any], question: str, opts: ChatOptions) -> ChatResponse:
+    # 3) ejecutar
+    conn, res = _sql_open(ctx)
+    try:
+        rows = res.fetchall()
+        cols = list(res.keys())
+    except SQLAlchemyError as e:
+        raise _sql_error(e, ctx["sql"])
+    finally:
+        conn.close()
+    return _sql_response(ctx, question, opts, cols, _frame_rows(pd.DataFrame(rows, columns=cols)))
 
-def answer_excel(question: str, source: ExcelSource, opts: ChatOptions) -> ChatResponse:
-    # 0) Carga de datos y esquema
-    df = (
-        pd.read_csv(source.path)
-        if source.path.lower().endswith(".csv")
-        else pd.read_excel(source.path, sheet_name=source.sheet_name)
-    )
-    schema = extract_excel_schema(source.path, sheet_name=source.sheet_name)
 
-    # 1) PLAN por LLM tipado (structured output) con fallback a reglas
+async def _sql_execute_streamed(
+    ctx: Dict[str, Any], question: str, opts: ChatOptions, chunk_rows: int
+) -> AsyncIterator[Tuple[str, Any]]:
+    # 3) ejecutar leyendo el cursor por bloques: cada bloque sale apenas llega de la base
+    conn, res = await run_in_threadpool(_sql_open, ctx)
     try:
-        # 👇 Fuerza el método clásico de function calling (evita el error de schema estricto)
-        structured = PLAN_PROMPT_FEWSHOT | llm.with_structured_output(
-            PlanModel, method="function_calling"
-        )
-        plan_obj: PlanModel = structured.invoke(
-            {"columns": schema["columns"], "question": question}
-        )
-        plan = plan_obj.dict()
-        print("DEBUG PLAN (LLM):", plan)
+        cols = list(res.keys())
+        yield "columns", {"columns": cols}
+        rows: List[List[Any]] = []
+        while True:
+            try:
+                chunk = await run_in_threadpool(res.fetchmany, chunk_rows)
+            except SQLAlchemyError as e:
+                raise _sql_error(e, ctx["sql"])
+            if not chunk:
+                break
+            block = _frame_rows(pd.DataFrame(chunk, columns=cols))
+            yield "rows", {"offset": len(rows), "rows": block}
+            rows.extend(block)
+    finally:
+        await run_in_threadpool(conn.close)
+    yield "result", await run_in_threadpool(_sql_response, ctx, question, opts, cols, rows)
+
+
+async def sql_stages(
+    question: str, sqlalchemy_url: str, opts: ChatOptions, conn_key: Optional[str] = None,
+    chunk_rows: Optional[int] = None,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Pipeline SQL por etapas: produce ("schema", …), ("generated", …) y por último
+    ("result", ChatResponse). La espera al LLM no ocupa un hilo; esquema/query van al threadpool.
+    Con chunk_rows, antes del resultado salen ("columns", …) y ("rows", …) a medida que se leen.
+    """
+    ctx = await run_in_threadpool(_sql_prepare, question, sqlalchemy_url, opts, conn_key)
+    yield "schema", {"tables": sorted(ctx["schema"]), "cached_sql": ctx["from_cache"]}
+    if not ctx["from_cache"]:
+        ctx["sql"] = sanitize_sql(await llm_gateway.ainvoke(_text_chain, ctx["prompt"]), limit=opts.max_rows)
+    yield "generated", {"type": "sql", "code": ctx["sql"]}
+    if chunk_rows:
+        async for item in _sql_execute_streamed(ctx, question, opts, chunk_rows):
+            yield item
+        return
+    yield "result", await run_in_threadpool(_sql_execute, ctx, question, opts)
+
+
+
+# =========================
+# Caches en memoria (Excel/CSV)
+# =========================
+# Plan validado (PlanModel.dict()) keyed por (columnas+dtypes, pregunta normalizada)
+plan_cache = LRUCache(max_items=int(os.getenv("PLAN_CACHE_MAX", "2000")))
+
+
+def _plan_cache_key(schema: Dict[str, Any], question: str) -> str:
+    cols = [[str(c), str(schema["dtypes"].get(c, ""))] for c in schema["columns"]]
+    raw = json.dumps([cols, _normalize_question(question)], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+# ========= Resultados memoizados por (contenido, hoja, plan) =========
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "128"))
+content_hash_cache = LRUCache(max_items=int(os.getenv("CONTENT_HASH_CACHE_MAX", "2000")))
+
+
+def file_content_hash(path: str) -> str:
+    """sha256 del archivo; se recalcula solo si cambian mtime/size."""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+    digest = content_hash_cache.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        content_hash_cache.put(key, digest)
+    return digest
+
+
+def _result_cache_key(
+    content_hash: str, sheet_name: Optional[Union[int, str]], plan: dict, max_rows: int, mode: str
+) -> str:
+    # plan canónico: mismo JSON aunque la pregunta se haya formulado distinto
+    raw = json.dumps(
+        [content_hash, str(sheet_name), plan, max_rows, mode], sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Tablas de salida (ya truncadas a max_rows) keyed por _result_cache_key. El hash de
+    contenido en la clave hace que un archivo modificado nunca reutilice resultados viejos;
+    invalidate_path libera las entradas de un archivo borrado. Presupuesto en bytes.
+    Los DataFrames devueltos son compartidos: NO mutarlos.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key: str) -> None:
+        # llamar con self._lock tomado
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["nbytes"]
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, List[str]]]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry["out"], list(entry["notices"])
+
+    def put(self, key: str, path: str, out: pd.DataFrame, notices: List[str]) -> None:
+        nbytes = int(out.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._items[key] = {
+                "out": out, "notices": list(notices), "nbytes": nbytes, "path": os.path.abspath(path),
+            }
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                self._drop(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate_path(self, path: str) -> int:
+        ap = os.path.abspath(path)
+        with self._lock:
+            keys = [k for k, e in self._items.items() if e["path"] == ap]
+            for k in keys:
+                self._drop(k)
+        return len(keys)
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._items)
+            self._items.clear()
+            self.bytes = 0
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+result_cache = ResultCache(max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+
+DF_CACHE_MAX_MB = int(os.getenv("DF_CACHE_MAX_MB", "512"))
+
+
+CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", "0.5"))  # únicos / filas
+
+
+def _iso_date_column(values: pd.Series) -> bool:
+    """
+    True si todos los valores (texto, sin nulos) son fechas AAAA-MM-DD. Solo ese formato:
+    datetime64 vuelve a ese mismo texto con astype(str), así filtros de texto (contains,
+    startswith), comparaciones con "2024-05-01" y la vista previa ven lo mismo que antes.
+    D/M/A no se convierte: pandas leería "01/05/2024" mes-primero en los filtros.
+    """
+    head = values.head(200)
+    if not head.map(lambda v: isinstance(v, str)).all() or not head.str.match(_ISO_DATE).all():
+        return False  # descarte barato antes de recorrer toda la columna
+    return bool(values.map(lambda v: isinstance(v, str)).all() and values.str.match(_ISO_DATE).all())
+
+
+def optimize_dtypes(
+    df: pd.DataFrame, label: str = "", profile: Optional[Dict[str, Any]] = None
+) -> pd.DataFrame:
+    """
+    Optimiza tipos al cargar: texto de baja cardinalidad → category, fechas ISO en texto →
+    datetime64, enteros → el int más chico, floats → float32 solo si no pierde precisión.
+    Con el perfil de columnas se usa su conteo de distintos en vez de recorrer la columna.
+    """
+    before = int(df.memory_usage(deep=True).sum())
+    known = (profile or {}).get("columns", {})
+    out = {}
+    for c in df.columns:
+        col = df[c]
+        p = known.get(str(c))
+        if col.dtype == object:
+            non_null = col.dropna()
+            if non_null.empty:
+                out[c] = col
+                continue
+            if _iso_date_column(non_null):
+                # todas deben ser fechas válidas; si una no (2024-02-31), la columna queda texto
+                parsed = pd.to_datetime(col, format=_ISO_DATE_FMT, errors="coerce")
+                if parsed.notna().sum() == len(non_null):
+                    out[c] = parsed
+                    continue
+            distinct = p["distinct"] if p else non_null.nunique()
+            if distinct <= CATEGORY_MAX_RATIO * len(col):
+                out[c] = col.astype("category")
+                continue
+        elif pd.api.types.is_integer_dtype(col.dtype) and not pd.api.types.is_bool_dtype(col.dtype):
+            out[c] = pd.to_numeric(col, downcast="integer")
+            continue
+        elif pd.api.types.is_float_dtype(col.dtype) and col.dtype != np.float32:
+            f32 = col.astype(np.float32)
+            if ((f32.astype(col.dtype) == col) | col.isna()).all():
+                out[c] = f32
+                continue
+        out[c] = col
+    opt = pd.DataFrame(out, index=df.index)
+    after = int(opt.memory_usage(deep=True).sum())
+    print(f"[dtypes] {label or 'df'}: {before / 1e6:.1f} MB → {after / 1e6:.1f} MB")
+    return opt
+
+
+def _read_table(path: str, sheet_name: Optional[Union[int, str]] = 0) -> pd.DataFrame:
+    """Lee un CSV/Excel completo (sin cache). Prefiere la copia columnar si existe."""
+    table = _read_columnar_table(path, sheet_name)
+    if table is not None:
+        return table.to_pandas()  # ya optimizada en la ingesta
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        df = pd.read_csv(path)
+    else:
+        # xlrd para .xls; openpyxl por defecto para .xlsx
+        df = pd.read_excel(path, sheet_name=sheet_name, engine="xlrd" if ext == ".xls" else None)
+    return optimize_dtypes(df, label=os.path.basename(path), profile=get_column_profile(path, sheet_name))
+
+
+class DataFrameCache:
+    """
+    DataFrames ya parseados keyed por (ruta, hoja). Cada entrada guarda mtime/size del
+    archivo: si cambian, se recarga. Presupuesto en bytes medido con memory_usage(deep=True).
+    Los DataFrames devueltos son compartidos: NO mutarlos.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(path: str, sheet_name: Optional[Union[int, str]]) -> Tuple[str, str]:
+        is_csv = path.lower().endswith(".csv")
+        return (os.path.abspath(path), "" if is_csv else str(0 if sheet_name is None else sheet_name))
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        # llamar con self._lock tomado
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["nbytes"]
+
+    def peek(self, path: str, sheet_name: Optional[Union[int, str]] = 0) -> Optional[pd.DataFrame]:
+        """Devuelve el DataFrame si está cacheado y vigente; no carga ni cuenta métricas."""
+        key = self._key(path, sheet_name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and (entry["mtime"], entry["size"]) == (st.st_mtime, st.st_size):
+                return entry["df"]
+        return None
+
+    def get(self, path: str, sheet_name: Optional[Union[int, str]] = 0) -> pd.DataFrame:
+        key = self._key(path, sheet_name)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and (entry["mtime"], entry["size"]) == (st.st_mtime, st.st_size):
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry["df"]
+            self._drop(key)  # versión vieja del archivo
+            self.misses += 1
+
+        df = _read_table(path, sheet_name)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            print(f"[df_cache] {os.path.basename(path)} ({nbytes} bytes) excede el presupuesto; no se cachea")
+            return df
+
+        with self._lock:
+            self._drop(key)
+            self._items[key] = {"df": df, "nbytes": nbytes, "mtime": st.st_mtime, "size": st.st_size}
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                old_key = next(iter(self._items))
+                self._drop(old_key)
+                self.evictions += 1
+        return df
+
+    def invalidate_path(self, path: str) -> int:
+        ap = os.path.abspath(path)
+        with self._lock:
+            keys = [k for k in self._items if k[0] == ap]
+            for k in keys:
+                self._drop(k)
+        return len(keys)
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._items)
+            self._items.clear()
+            self.bytes = 0
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+df_cache = DataFrameCache(max_bytes=DF_CACHE_MAX_MB * 1024 * 1024)
+
+
+def load_dataframe(path: str, sheet_name: Optional[Union[int, str]] = 0) -> pd.DataFrame:
+    return df_cache.get(path, sheet_name)
+
+
+@app.get("/admin/df-cache")
+def admin_df_cache_stats(_: dict = Depends(require_roles(["admin"]))):
+    return df_cache.stats()
+
+
+@app.delete("/admin/df-cache")
+def admin_df_cache_clear(admin=Depends(require_roles(["admin"]))):
+    cleared = df_cache.clear()
+    log_event("info", "df_cache_clear", actor=admin["email"], path="/admin/df-cache", meta={"cleared": cleared})
+    return {"cleared": cleared}
 
-    except Exception as e:
-        print("WARN: PLAN LLM falló, usando plan por reglas:", e)
-        plan = make_plan_rule_based(question, schema)
-        print("DEBUG PLAN (RULE):", plan)
+
+@app.get("/admin/plan-cache")
+def admin_plan_cache_stats(_: dict = Depends(require_roles(["admin"]))):
+    return plan_cache.stats()
+
+
+@app.delete("/admin/plan-cache")
+def admin_plan_cache_clear(admin=Depends(require_roles(["admin"]))):
+    cleared = plan_cache.invalidate()
+    log_event("info", "plan_cache_clear", actor=admin["email"], path="/admin/plan-cache", meta={"cleared": cleared})
+    return {"cleared": cleared}
+
+
+@app.get("/admin/result-cache")
+def admin_result_cache_stats(_: dict = Depends(require_roles(["admin"]))):
+    return result_cache.stats()
+
+
+@app.delete("/admin/result-cache")
+def admin_result_cache_clear(admin=Depends(require_roles(["admin"]))):
+    cleared = result_cache.clear()
+    log_event("info", "result_cache_clear", actor=admin["email"], path="/admin/result-cache", meta={"cleared": cleared})
+    return {"cleared": cleared}
+
+
+def _excel_prepare(question: str, source: ExcelSource, approx: bool = False) -> Dict[str, Any]:
+    # 0) Carga de datos (cache de DataFrames parseados) y esquema.
+    #    CSV más grandes que CSV_STREAMING_MB no se cargan: el plan se ejecuta por chunks.
+    #    En modo aproximado tampoco: el plan corre sobre get_sample (muestreo durante la lectura).
+    streaming = _csv_needs_streaming(source.path)
+    if streaming or approx:
+        df = None
+        schema = extract_excel_schema(source.path, sheet_name=source.sheet_name)  # muestra
+    else:
+        df = load_dataframe(source.path, source.sheet_name)
+        schema = extract_excel_schema(df)  # del frame ya cargado, sin segunda lectura
+    profile = get_column_profile(source.path, source.sheet_name)  # calculado al subir (si existe)
+
+    # 1) PLAN: cache → LLM tipado (structured output) → fallback a reglas
+    plan_key = _plan_cache_key(schema, question)
+    plan = plan_cache.get(plan_key)
+    if plan is not None:
+        plan = copy.deepcopy(plan)  # la entrada cacheada no se comparte entre requests
+    return {
+        "source": source, "streaming": streaming, "df": df, "schema": schema, "profile": profile,
+        "plan_key": plan_key, "plan": plan,
+        "plan_input": {"columns": _plan_columns_hint(schema, profile), "question": question},
+    }
+
+
+def _plan_chain(model):
+    # 👇 Fuerza el método clásico de function calling (evita el error de schema estricto)
+    return PLAN_PROMPT_FEWSHOT | model.with_structured_output(PlanModel, method="function_calling")
+
+
+def _excel_plan_from_llm(ctx: Dict[str, Any], plan_obj: PlanModel) -> dict:
+    plan = plan_obj.dict()
+    print("DEBUG PLAN (LLM):", plan)
+    # solo planes del LLM; el de reglas es barato y no debe fijar un fallo transitorio
+    plan_cache.put(ctx["plan_key"], copy.deepcopy(plan))
+    return plan
+
+
+def _excel_plan_fallback(ctx: Dict[str, Any], question: str, error: Exception) -> dict:
+    print("WARN: PLAN LLM falló, usando plan por reglas:", error)
+    plan = make_plan_rule_based(question, ctx["schema"])
+    print("DEBUG PLAN (RULE):", plan)
+    return plan
+
+
+def _excel_build_code(ctx: Dict[str, Any], question: str) -> None:
+    """Valida filtros y arma la expresión; si no se puede, deja ctx["code_prompt"] para el LLM."""
+    plan = ctx["plan"]
+    # valores de filtros contra los conocidos del perfil (corrige mayúsculas/tildes)
+    ctx["filter_notices"] = validate_plan_filters(plan, ctx["profile"])
 
     # 2) Construcción determinista de la expresión Pandas
+    ctx["llm_code"] = False
+    ctx["code_prompt"] = None
     try:
-        py_code = build_pandas_expr(plan)
-        print("DEBUG py_code:", py_code)
+        ctx["py_code"] = build_pandas_expr(plan)
+        print("DEBUG py_code:", ctx["py_code"])
     except Exception as e:
+        if ctx["streaming"]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Archivo demasiado grande para código libre; reformula la pregunta ({e})",
+            )
+        ctx["llm_code"] = True
+        ctx["py_code"] = None
         # 3) Último fallback: pedir expresión directa al LLM (por robustez)
         print("WARN: build_pandas_expr falló, fallback a generador directo:", e)
-        prompt = PANDAS_PROMPT.format_messages(
-            columns=schema["columns"], dtypes=schema["dtypes"], question=question
+        ctx["code_prompt"] = PANDAS_PROMPT.format_messages(
+            columns=ctx["schema"]["columns"], dtypes=ctx["schema"]["dtypes"], question=question
         )
-        py_code_raw = (llm | parser).invoke(prompt)
-        # Desenvuelve bloque ``` y quita "out = ..." si viniera así
-        py_code = _unwrap_code_block(py_code_raw).strip()
-        if py_code.startswith("out ="):
-            py_code = py_code.split("=", 1)[1].strip()
-        print("DEBUG py_code (FALLBACK):", py_code)
-
-    # 4) Ejecutar de forma segura
+
+
+def _llm_code_expr(py_code_raw: str) -> str:
+    # Desenvuelve bloque ``` y quita "out = ..." si viniera así
+    py_code = _unwrap_code_block(py_code_raw).strip()
+    if py_code.startswith("out ="):
+        py_code = py_code.split("=", 1)[1].strip()
+    print("DEBUG py_code (FALLBACK):", py_code)
+    return py_code
+
+
+def _excel_compute(ctx: Dict[str, Any], opts: ChatOptions) -> Tuple[pd.DataFrame, List[str]]:
+    source, plan, py_code, llm_code = ctx["source"], ctx["plan"], ctx["py_code"], ctx["llm_code"]
+    filter_notices = ctx["filter_notices"]
+    notices: List[str] = list(filter_notices)
+
+    # 4) Ejecutar: plan → intérprete directo (o por chunks); código libre del LLM → sandbox sobre una copia.
+    #    Resultados de planes memoizados por contenido del archivo: otra redacción, mismo plan → sin recomputar.
+    result_key, cached = None, None
+    if not llm_code:
+        result_key = _result_cache_key(
+            file_content_hash(source.path), source.sheet_name, plan, opts.max_rows, opts.mode
+        )
+        cached = result_cache.get(result_key)
     try:
-        out = exec_pandas(py_code, df)
+        if cached is not None:
+            out, exec_notices = cached
+            notices += exec_notices
+        elif opts.mode == "approx" and not llm_code:
+            sample, population = get_sample(source.path, source.sheet_name)
+            if population > len(sample):
+                out, exec_notices = execute_plan_approx(plan, sample, population)
+                notices += exec_notices
+            else:
+                out = execute_plan(plan, sample)  # la "muestra" es el archivo completo
+        elif ctx["streaming"]:
+            out, exec_notices = execute_plan_chunked(plan, source.path)
+            notices += exec_notices
+        elif llm_code:
+            df = ctx["df"] if ctx["df"] is not None else load_dataframe(source.path, source.sheet_name)
+            out = exec_pandas(py_code, df.copy())  # df es compartido (cache)
+        else:
+            df = ctx["df"] if ctx["df"] is not None else load_dataframe(source.path, source.sheet_name)
+            out = execute_plan(plan, df)
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -1890,10 +4656,16 @@ def answer_excel(question: str, source: ExcelSource, opts: ChatOptions) -> ChatR
     # 5) Limitar y empaquetar respuesta
     if len(out) > opts.max_rows:
         out = out.head(opts.max_rows)
+    if result_key is not None and cached is None:
+        result_cache.put(result_key, source.path, out, notices[len(filter_notices):])
+    return out, notices
+
 
+def _excel_response(ctx: Dict[str, Any], question: str, opts: ChatOptions, out: pd.DataFrame,
+                    notices: List[str], rows: Optional[List[List[Any]]] = None) -> ChatResponse:
     table = TableData(
         columns=[str(c) for c in out.columns],
-        rows=out.astype(object).where(pd.notnull(out), None).values.tolist(),
+        rows=rows if rows is not None else _frame_rows(_dates_as_text(out)),
     )
 
     lang = _detect_lang(question, getattr(opts, "language", None))
@@ -1905,74 +4677,92 @@ def answer_excel(question: str, source: ExcelSource, opts: ChatOptions) -> ChatR
 
     return ChatResponse(
         answer_text=answer_text,
-        generated={"type": "pandas", "code": py_code},
+        generated={"type": "pandas", "code": ctx["py_code"]},
         table=table,
-        notices=[],
+        notices=notices,
     )
 
 
+def _excel_execute(ctx: Dict[str, Any], question: str, opts: ChatOptions) -> ChatResponse:
+    out, notices = _excel_compute(ctx, opts)
+    return _excel_response(ctx, question, opts, out, notices)
+
+
+async def excel_stages(
+    question: str, source: ExcelSource, opts: ChatOptions, chunk_rows: Optional[int] = None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Pipeline Excel/CSV por etapas (schema → plan → generated → result); LLM con ainvoke, el resto en threadpool.
+    Con chunk_rows, apenas está el resultado salen ("columns", …) y ("rows", …) convertidos bloque a bloque.
+    """
+    ctx = await run_in_threadpool(_excel_prepare, question, source, opts.mode == "approx")
+    yield "schema", {"columns": [str(c) for c in ctx["schema"]["columns"]], "streaming": ctx["streaming"]}
+    if ctx["plan"] is None:
+        try:
+            # circuito abierto / timeout → LLMUnavailable → plan por reglas sin esperar
+            ctx["plan"] = _excel_plan_from_llm(ctx, await llm_gateway.ainvoke(_plan_chain, ctx["plan_input"]))
+        except Exception as e:
+            ctx["plan"] = _excel_plan_fallback(ctx, question, e)
+    _excel_build_code(ctx, question)
+    yield "plan", ctx["plan"]
+    if ctx["code_prompt"] is not None:
+        ctx["py_code"] = _llm_code_expr(await llm_gateway.ainvoke(_text_chain, ctx["code_prompt"]))
+    yield "generated", {"type": "pandas", "code": ctx["py_code"]}
+    if not chunk_rows:
+        yield "result", await run_in_threadpool(_excel_execute, ctx, question, opts)
+        return
+    out, notices = await run_in_threadpool(_excel_compute, ctx, opts)
+    yield "columns", {"columns": [str(c) for c in out.columns]}
+    shown = _dates_as_text(out)  # una vez sobre todo el resultado: mismo formato en cada bloque
+    rows: List[List[Any]] = []
+    for i in range(0, len(out), chunk_rows):
+        block = _frame_rows(shown.iloc[i:i + chunk_rows])
+        yield "rows", {"offset": i, "rows": block}
+        rows.extend(block)
+    yield "result", await run_in_threadpool(_excel_response, ctx, question, opts, out, notices, rows)
+
+
 # =========================
 # FastAPI
 # =========================
 
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(
-    req: ChatRequest,
-    payload: dict = Depends(require_non_admin),
-    db: Session = Depends(get_db),
-):
-    if str(payload.get("role", "")).lower() == "admin":
-        raise HTTPException(status_code=403, detail="Admins no pueden usar el chatbot")
-
+def _resolve_excel_datasource(ds) -> Tuple[str, Any]:
+    """(ruta en disco, datasource con path/sheet_name resueltos) para un datasource excel."""
+    file_id = getattr(ds, "file_id", None) or (ds.dict().get("file_id") if hasattr(ds, "dict") else None)
+    path = getattr(ds, "path", None) or (ds.dict().get("path") if hasattr(ds, "dict") else None)
+    if not path and not file_id:
+        raise HTTPException(status_code=400, detail="Excel: debes enviar file_id o path")
+    resolved_path = _path_from_file_id(file_id) if file_id else path
+    sheet_name = getattr(ds, "sheet_name", None)
+    if sheet_name is None:
+        sheet_name = 0
     try:
-        ds = req.datasource
-
-        if ds.type == "excel":
-            file_id = getattr(ds, "file_id", None) or (ds.dict().get("file_id") if hasattr(ds, "dict") else None)
-            path = getattr(ds, "path", None) or (ds.dict().get("path") if hasattr(ds, "dict") else None)
-            if not path and not file_id:
-                raise HTTPException(status_code=400, detail="Excel: debes enviar file_id o path")
-            resolved_path = _path_from_file_id(file_id) if file_id else path
-            sheet_name = getattr(ds, "sheet_name", None)
-            if sheet_name is None:
-                sheet_name = 0
-            try:
-                resolved_ds = ds.model_copy(update={"path": resolved_path, "sheet_name": sheet_name, "file_id": None})
-            except Exception:
-                _d = dict(ds if isinstance(ds, dict) else ds.dict())
-                _d.update({"path": resolved_path, "sheet_name": sheet_name, "file_id": None, "type": "excel"})
-                resolved_ds = _d
-            resp = answer_excel(req.question, resolved_ds, req.options)
-
-        elif ds.type in ("mysql", "postgres", "sqlite"):
-            resp = answer_sql(req.question, ds.sqlalchemy_url, req.options)
-
-        elif ds.type == "saved":
-            conn = db.query(Connection).filter_by(id=ds.connection_id, is_active=True).first()
-            if not conn:
-                raise HTTPException(status_code=404, detail="Conexión no encontrada o inactiva")
-            resp = answer_sql(req.question, conn.sqlalchemy_url, req.options)
-        else:
-            raise HTTPException(status_code=400, detail="Datasource no soportado")
+        resolved_ds = ds.model_copy(update={"path": resolved_path, "sheet_name": sheet_name, "file_id": None})
+    except Exception:
+        _d = dict(ds if isinstance(ds, dict) else ds.dict())
+        _d.update({"path": resolved_path, "sheet_name": sheet_name, "file_id": None, "type": "excel"})
+        resolved_ds = _d
+    return resolved_path, resolved_ds
 
-        # >>> ADD: log éxito de consulta
-        rc = len(resp.table.rows) if resp.table and resp.table.rows else 0
-        log_event("info", "query_ok", actor=payload.get("sub"), path="/chat",
-                  meta={"datasource": ds.type, "rows": rc, "lang": req.options.language})
 
-    except HTTPException as e:
-        # >>> ADD: log error funcional
-        log_event("error", "query_error", actor=payload.get("sub"), path="/chat",
-                  meta={"status": e.status_code, "detail": str(e.detail), "datasource": getattr(req.datasource, "type", None)})
+def _ingest_sqlite_for_chat(path: str) -> str:
+    try:
+        return ingest_sqlite(path)
+    except HTTPException:
         raise
     except Exception as e:
-        # >>> ADD: log error inesperado
-        log_event("error", "query_error", actor=payload.get("sub"), path="/chat",
-                  meta={"status": 500, "detail": str(e), "datasource": getattr(req.datasource, "type", None)})
-        raise
+        raise HTTPException(status_code=400, detail=f"No se pudo importar el archivo a SQLite: {e}")
+
+
+def _saved_connection(db: Session, connection_id: int) -> Connection:
+    conn = db.query(Connection).filter_by(id=connection_id, is_active=True).first()
+    if not conn:
+        raise HTTPException(status_code=404, detail="Conexión no encontrada o inactiva")
+    return conn
+
 
-    # (historial se mantiene igual)
+def _record_history(payload: dict, req: ChatRequest, resp: ChatResponse) -> None:
     try:
         user_id = str(payload.get("sub") or payload.get("user_id") or payload.get("email") or "anonymous")
         row_count = len(resp.table.rows) if resp.table and resp.table.rows else 0
@@ -1987,9 +4777,261 @@ def chat(
     except Exception as _e:
         print("WARN: no se pudo guardar historial:", _e)
 
+
+async def _resolve_chat_target(req: ChatRequest, db: Session) -> Tuple[str, Dict[str, Any]]:
+    """("sql", {url, conn_key}) o ("excel", {source}); errores de datasource como HTTPException."""
+    ds = req.datasource
+
+    if ds.type == "excel":
+        resolved_path, resolved_ds = await run_in_threadpool(_resolve_excel_datasource, ds)
+        if req.options.excel_engine == "sqlite":
+            # mismo archivo, importado a SQLite (una tabla por hoja) y respondido por el camino SQL
+            sqlite_url = await run_in_threadpool(_ingest_sqlite_for_chat, resolved_path)
+            return "sql", {"url": sqlite_url, "conn_key": _sqlite_conn_key(resolved_path)}
+        return "excel", {"source": resolved_ds}
+
+    elif ds.type in ("mysql", "postgres", "sqlite"):
+        return "sql", {"url": ds.sqlalchemy_url, "conn_key": None}
+
+    elif ds.type == "saved":
+        conn = await run_in_threadpool(_saved_connection, db, ds.connection_id)
+        return "sql", {"url": conn.sqlalchemy_url, "conn_key": f"conn:{conn.id}"}
+    else:
+        raise HTTPException(status_code=400, detail="Datasource no soportado")
+
+
+class SingleFlight:
+    """
+    Coalescing de preguntas idénticas concurrentes: la primera corre como tarea propia y
+    las que llegan mientras tanto esperan ese mismo resultado (o excepción). La tarea está
+    protegida con shield: si el cliente que la inició se desconecta, los demás la reciben igual.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[str, "asyncio.Task"] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    def _forget(self, key: str, task: "asyncio.Task") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def join(self, key: str) -> Optional[Awaitable[Any]]:
+        """Awaitable del cálculo en vuelo para key, o None si no hay ninguno."""
+        task = self._inflight.get(key)
+        if task is None:
+            return None
+        self.joined += 1
+        return asyncio.shield(task)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        joined = self.join(key)
+        if joined is not None:
+            return await joined
+        task = asyncio.ensure_future(factory())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._forget(key, t))
+        self.leaders += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "joined": self.joined}
+
+
+chat_flights = SingleFlight()
+
+
+def _flight_key(req: ChatRequest, target: Tuple[str, Dict[str, Any]]) -> str:
+    # identidad del datasource: archivo (ya direccionado por contenido) + hoja, o conexión/URL.
+    # No incluye al usuario: el acceso lo decide la resolución del datasource y ChatResponse
+    # no tiene nada propio del usuario, así que N usuarios con la misma pregunta comparten cálculo
+    kind, t = target
+    if kind == "excel":
+        src = t["source"]
+        ds_id = ["excel", os.path.abspath(src.path), str(src.sheet_name)]
+    else:
+        ds_id = ["sql", t["conn_key"] or hashlib.sha1(t["url"].encode("utf-8")).hexdigest()]
+    raw = json.dumps(
+        [ds_id, _normalize_question(req.question), req.options.model_dump()],
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+async def _chat_result(req: ChatRequest, target: Tuple[str, Dict[str, Any]]) -> ChatResponse:
+    resp = None
+    async for stage, data in _chat_stages(req, target):
+        if stage == "result":
+            resp = data
     return resp
 
 
+def _chat_stages(
+    req: ChatRequest, target: Tuple[str, Dict[str, Any]], chunk_rows: Optional[int] = None
+) -> AsyncIterator[Tuple[str, Any]]:
+    kind, t = target
+    if kind == "excel":
+        return excel_stages(req.question, t["source"], req.options, chunk_rows=chunk_rows)
+    return sql_stages(req.question, t["url"], req.options, conn_key=t["conn_key"], chunk_rows=chunk_rows)
+
+
+async def _log_chat_ok(req: ChatRequest, payload: dict, resp: ChatResponse, path: str = "/chat") -> None:
+    rc = len(resp.table.rows) if resp.table and resp.table.rows else 0
+    await run_in_threadpool(
+        log_event, "info", "query_ok", actor=payload.get("sub"), path=path,
+        meta={"datasource": req.datasource.type, "rows": rc, "lang": req.options.language},
+    )
+    await run_in_threadpool(_record_history, payload, req, resp)
+
+
+async def _log_chat_error(req: ChatRequest, payload: dict, status_code: int, detail: str, path: str = "/chat") -> None:
+    await run_in_threadpool(
+        log_event, "error", "query_error", actor=payload.get("sub"), path=path,
+        meta={"status": status_code, "detail": detail, "datasource": getattr(req.datasource, "type", None)},
+    )
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(
+    req: ChatRequest,
+    payload: dict = Depends(require_non_admin),
+    db: Session = Depends(get_db),
+):
+    # async: mientras se espera al LLM no se ocupa ningún hilo; lo bloqueante
+    # (archivos, SQLite, queries, pandas) va al threadpool
+    if str(payload.get("role", "")).lower() == "admin":
+        raise HTTPException(status_code=403, detail="Admins no pueden usar el chatbot")
+
+    try:
+        target = await _resolve_chat_target(req, db)
+        # preguntas idénticas en vuelo comparten un solo cálculo (LLM + query);
+        # log e historial siguen siendo por request/usuario
+        resp = await chat_flights.do(_flight_key(req, target), lambda: _chat_result(req, target))
+    except HTTPException as e:
+        await _log_chat_error(req, payload, e.status_code, str(e.detail))
+        raise
+    except Exception as e:
+        await _log_chat_error(req, payload, 500, str(e))
+        raise
+
+    # log de éxito + historial (se mantiene igual)
+    await _log_chat_ok(req, payload, resp)
+    return resp
+
+
+@app.get("/admin/llm")
+def admin_llm_stats(_: dict = Depends(require_roles(["admin"]))):
+    return llm_gateway.stats()
+
+
+@app.get("/admin/chat-flights")
+def admin_chat_flights(_: dict = Depends(require_roles(["admin"]))):
+    return chat_flights.stats()
+
+
+CHAT_STREAM_CHUNK_ROWS = int(os.getenv("CHAT_STREAM_CHUNK_ROWS", "500"))
+_background_tasks: set = set()
+
+
+def _spawn(coro: Awaitable[Any]) -> None:
+    # referencia fuerte hasta que termine (el loop solo guarda referencias débiles)
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    req: ChatRequest,
+    payload: dict = Depends(require_non_admin),
+    db: Session = Depends(get_db),
+):
+    """
+    Variante de /chat con Server-Sent Events. Eventos, en orden:
+    schema → plan (solo Excel/CSV) → generated → columns → rows (en bloques de
+    CHAT_STREAM_CHUNK_ROWS, a medida que se leen) → answer. Si algo falla a mitad de camino
+    llega un evento error. Log e historial se registran aunque el cliente corte el stream.
+    """
+    if str(payload.get("role", "")).lower() == "admin":
+        raise HTTPException(status_code=403, detail="Admins no pueden usar el chatbot")
+
+    # el datasource se resuelve antes de abrir el stream: 4xx siguen siendo respuestas HTTP normales
+    try:
+        target = await _resolve_chat_target(req, db)
+    except HTTPException as e:
+        await _log_chat_error(req, payload, e.status_code, str(e.detail), path="/chat/stream")
+        raise
+
+    async def events():
+        resp: Optional[ChatResponse] = None
+        generated: Optional[Dict[str, Any]] = None
+        columns: List[str] = []
+        sent_rows: List[List[Any]] = []
+        failed = False
+        try:
+            inflight = chat_flights.join(_flight_key(req, target))
+            if inflight is not None:
+                # la misma pregunta ya se está calculando para /chat: se espera ese resultado
+                resp = await inflight
+                generated = resp.generated
+                columns = resp.table.columns if resp.table else []
+                yield _sse("columns", {"columns": columns})
+                rows = resp.table.rows if resp.table else []
+                for i in range(0, len(rows), CHAT_STREAM_CHUNK_ROWS):
+                    yield _sse("rows", {"offset": i, "rows": rows[i:i + CHAT_STREAM_CHUNK_ROWS]})
+                    sent_rows.extend(rows[i:i + CHAT_STREAM_CHUNK_ROWS])
+            else:
+                # las filas salen a medida que la query / el resultado las va entregando
+                # aclosing: si el cliente corta, el cursor/conexión de la etapa se cierra ya
+                async with aclosing(_chat_stages(req, target, chunk_rows=CHAT_STREAM_CHUNK_ROWS)) as stages:
+                    async for stage, data in stages:
+                        if stage == "result":
+                            resp = data
+                            continue
+                        if stage == "generated":
+                            generated = data
+                        elif stage == "columns":
+                            columns = data["columns"]
+                        elif stage == "rows":
+                            sent_rows.extend(data["rows"])
+                        yield _sse(stage, data)
+            yield _sse("answer", {
+                "answer_text": resp.answer_text,
+                "generated": resp.generated,
+                "notices": resp.notices,
+                "total": len(sent_rows),
+            })
+        except HTTPException as e:
+            failed = True
+            await _log_chat_error(req, payload, e.status_code, str(e.detail), path="/chat/stream")
+            yield _sse("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            failed = True
+            await _log_chat_error(req, payload, 500, str(e), path="/chat/stream")
+            yield _sse("error", {"status": 500, "detail": str(e)})
+        finally:
+            # también corre si el cliente se desconecta a mitad del stream (GeneratorExit /
+            # cancelación); por eso el registro va en una tarea aparte y no se espera acá
+            if not failed and (resp is not None or generated is not None):
+                if resp is None:
+                    resp = ChatResponse(
+                        answer_text="(respuesta interrumpida: el cliente se desconectó)",
+                        generated=generated,
+                        table=TableData(columns=columns, rows=sent_rows),
+                    )
+                _spawn(_log_chat_ok(req, payload, resp, path="/chat/stream"))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/history", response_model=HistoryList)
 def get_history(
     limit: int = 100,
@@ -2073,10 +5115,8 @@ def excel_sheets(
 
     try:
         if ext in {".xlsx", ".xls"}:
-            # Usa xlrd para .xls; para .xlsx deja que pandas elija (openpyxl)
-            engine = "xlrd" if ext == ".xls" else None
-            with pd.ExcelFile(resolved_path, engine=engine) as xf:
-                sheet_names = xf.sheet_names
+            # metadata capturada en el upload / primer acceso: no se abre el workbook
+            sheet_names = [sh["name"] for sh in get_workbook_meta(resolved_path)["sheets"]]
             log_event(
                 "info",
                 "excel_sheets",
@@ -2111,7 +5151,64 @@ def excel_sheets(
         raise HTTPException(status_code=400, detail=f"No fue posible leer el archivo: {e}")
 
 
-    
+
+def _norm_preview_sheet(s):
+    # --- Normaliza sheet_name para Excel ---
+    if s is None:
+        return 0
+    if isinstance(s, str):
+        s2 = s.strip()
+        if s2 == "" or s2 == "__csv__":
+            return 0
+        try:
+            return int(s2)  # si viene "0", "1", ...
+        except Exception:
+            return s2        # nombre de hoja
+    return s
+
+
+def _xlsx_worksheet(wb, sheet_name: Union[int, str]):
+    if isinstance(sheet_name, int):
+        if not 0 <= sheet_name < len(wb.worksheets):
+            raise ValueError(f"Hoja fuera de rango: {sheet_name}")
+        return wb.worksheets[sheet_name]
+    if sheet_name not in wb.sheetnames:
+        raise ValueError(f"Hoja no encontrada: {sheet_name}")
+    return wb[sheet_name]
+
+
+def _xlsx_header(values) -> List[str]:
+    # mismo criterio que pandas para encabezados vacíos
+    return [f"Unnamed: {i}" if v is None else str(v) for i, v in enumerate(values)]
+
+
+def read_xlsx_window(
+    path: str, sheet_name: Union[int, str], offset: int, limit: int
+) -> Tuple[List[str], List[List[Any]], int]:
+    """
+    Lee solo las filas [offset, offset+limit) con openpyxl read-only (iter_rows).
+    Devuelve (columns, rows, total); columnas y total salen de la metadata del workbook
+    (el total, del perfil de columnas si existe: la dimensión del xlsx cuenta filas vacías).
+    """
+    sh = _workbook_sheet_meta(get_workbook_meta(path), sheet_name)
+    profile = get_column_profile(path, sheet_name)
+    columns, total = sh["columns"], (profile["rows"] if profile else sh["rows"])
+    rows: List[List[Any]] = []
+    if offset >= total:
+        return columns, rows, total
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = _xlsx_worksheet(wb, sheet_name)
+        for values in ws.iter_rows(min_row=2 + offset, max_row=1 + offset + limit, values_only=True):
+            row = list(values[:len(columns)])
+            row += [None] * (len(columns) - len(row))
+            rows.append(row)
+    finally:
+        wb.close()
+    return columns, rows, total
+
+
 @app.get("/excel/preview")
 def excel_preview(
     sheet_name: Optional[Union[str, int]] = Query(None, description="Nombre o índice de la hoja (Excel)"),
@@ -2131,26 +5228,61 @@ def excel_preview(
     ext = os.path.splitext(resolved_path)[1].lower()
 
     try:
+        # --- Copia columnar: se corta la ventana sobre el mmap, sin leer la hoja entera ---
+        table = _read_columnar_table(resolved_path, _norm_preview_sheet(sheet_name))
+        if table is not None:
+            total = int(table.num_rows)
+            window = table.slice(offset, limit).to_pandas() if offset < total else table.schema.empty_table().to_pandas()
+            rows = _frame_rows(_dates_as_text(window))
+            log_event(
+                "info", "excel_preview",
+                actor=(user.get("sub") or user.get("email")),
+                path="/excel/preview",
+                meta={
+                    "file": os.path.basename(resolved_path),
+                    "sheet": str(sheet_name),
+                    "columnar": True,
+                    "returned": len(rows),
+                    "total": total,
+                    "offset": offset,
+                    "limit": limit
+                }
+            )
+            return {
+                "columns": [str(c) for c in table.column_names],
+                "rows": rows,
+                "page": {"offset": offset, "limit": limit, "total": total},
+            }
+
         if ext in {".xlsx", ".xls"}:
             # --- Normaliza sheet_name para Excel ---
-            def _norm_sheet(s):
-                if s is None:
-                    return 0
-                if isinstance(s, str):
-                    s2 = s.strip()
-                    if s2 == "" or s2 == "__csv__":
-                        return 0
-                    try:
-                        return int(s2)  # si viene "0", "1", ...
-                    except Exception:
-                        return s2        # nombre de hoja
-                return s
-
-            target_sheet = _norm_sheet(sheet_name)
-
-            # --- Usa xlrd para .xls; openpyxl por defecto para .xlsx ---
-            engine = "xlrd" if ext == ".xls" else None
-            df = pd.read_excel(resolved_path, sheet_name=target_sheet, engine=engine)
+            target_sheet = _norm_preview_sheet(sheet_name)
+
+            # --- .xlsx aún no parseado: ventana streaming (memoria plana, sin leer la hoja entera) ---
+            if ext == ".xlsx" and df_cache.peek(resolved_path, target_sheet) is None:
+                columns, rows, total = read_xlsx_window(resolved_path, target_sheet, offset, limit)
+                log_event(
+                    "info", "excel_preview",
+                    actor=(user.get("sub") or user.get("email")),
+                    path="/excel/preview",
+                    meta={
+                        "file": os.path.basename(resolved_path),
+                        "sheet": str(target_sheet),
+                        "streaming": True,
+                        "returned": len(rows),
+                        "total": total,
+                        "offset": offset,
+                        "limit": limit
+                    }
+                )
+                return {
+                    "columns": columns,
+                    "rows": rows,
+                    "page": {"offset": offset, "limit": limit, "total": total},
+                }
+
+            # --- cache compartido con /chat (xlrd para .xls; openpyxl para .xlsx) ---
+            df = load_dataframe(resolved_path, target_sheet)
 
             total = int(len(df))
             if offset >= total:
@@ -2179,7 +5311,7 @@ def excel_preview(
                 )
                 return result
 
-            window = df.iloc[offset: offset + limit]
+            window = _dates_as_text(df.iloc[offset: offset + limit])
             columns = list(window.columns.astype(str))
             rows = window.where(pd.notna(window), None).values.tolist()
 
@@ -2221,10 +5353,8 @@ def excel_preview(
             head_df = pd.read_csv(resolved_path, nrows=0)
             columns = list(head_df.columns.astype(str))
 
-            with open(resolved_path, "r", encoding="utf-8", errors="ignore") as f:
-                total = sum(1 for _ in f) - 1
-                if total < 0:
-                    total = 0
+            # mismo índice (registros, no líneas) que usa read_csv_window para paginar
+            total = int(get_csv_row_index(resolved_path)["total"])
 
             if offset >= total:
                 log_event(
@@ -2252,13 +5382,8 @@ def excel_preview(
                 )
                 return result
 
-            window = pd.read_csv(
-                resolved_path,
-                skiprows=range(1, 1 + offset),  # saltar header + offset
-                nrows=limit,
-                header=None,
-            )
-            window.columns = columns
+            # seek por índice de offsets (no re-tokeniza las filas anteriores)
+            window = read_csv_window(resolved_path, columns, offset, limit)
             rows = window.where(pd.notna(window), None).values.tolist()
 
             log_event(
@@ -0,0 +1,29 @@
+"""
+Aísla los efectos de importar app_min: history.db, auth.db y uploads van a un directorio
+temporal, y routers.asr no carga el modelo de Whisper (los tests no usan /asr).
+"""
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_WORKDIR = tempfile.mkdtemp(prefix="datachat-tests-")
+_CWD = os.getcwd()
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["UPLOAD_DIR"] = os.path.join(_WORKDIR, "uploads")
+os.environ["AUTH_DB_URL"] = "sqlite:///" + os.path.join(_WORKDIR, "auth.db")
+os.chdir(_WORKDIR)  # ./backend/history.db es relativo al directorio actual
+sys.path.insert(0, BACKEND_DIR)
+
+# asr hace whisper.load_model("base") al importarse: descarga y CPU que ningún test necesita
+_whisper = types.ModuleType("whisper")
+_whisper.load_model = lambda *a, **k: None
+sys.modules["whisper"] = _whisper
+
+
+def pytest_unconfigure(config):
+    os.chdir(_CWD)
+    shutil.rmtree(_WORKDIR, ignore_errors=True)
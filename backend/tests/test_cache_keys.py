@@ -0,0 +1,34 @@
+"""Claves de cache: preguntas que solo difieren en el operador no deben compartir entrada."""
+import app_min
+
+SCHEMA = {"columns": ["region", "ventas"], "dtypes": {"region": "object", "ventas": "int64"}}
+
+
+def test_normalize_question_keeps_operators_and_numbers():
+    assert app_min._normalize_question("¿Ventas > 100?") == "ventas > 100"
+    assert app_min._normalize_question("ventas < 100") == "ventas < 100"
+    assert app_min._normalize_question("Precio 3.5, o -2!") == "precio 3.5 o -2"
+
+
+def test_plan_cache_key_differs_by_operator():
+    assert app_min._plan_cache_key(SCHEMA, "ventas > 100") != app_min._plan_cache_key(SCHEMA, "ventas < 100")
+    # la puntuación de frase y las mayúsculas sí se pliegan
+    assert app_min._plan_cache_key(SCHEMA, "¿Ventas > 100?") == app_min._plan_cache_key(SCHEMA, "ventas > 100")
+
+
+def test_plan_cache_does_not_serve_opposite_filter():
+    cache = app_min.LRUCache(max_items=10)
+    plan = {"operation": "count", "filters": [{"column": "ventas", "operator": ">", "value": 100}]}
+    cache.put(app_min._plan_cache_key(SCHEMA, "ventas > 100"), plan)
+    assert cache.get(app_min._plan_cache_key(SCHEMA, "ventas < 100")) is None
+    assert cache.get(app_min._plan_cache_key(SCHEMA, "ventas > 100")) == plan
+
+
+def test_sql_cache_key_differs_by_operator():
+    def key(q):
+        return app_min.SqlGenCache.make_key(
+            ds_key="conn:1", schema_hash="h", dialect="sqlite",
+            question_norm=app_min._normalize_question(q), max_rows=200,
+        )
+
+    assert key("empleados con salario > 1000") != key("empleados con salario < 1000")
@@ -0,0 +1,57 @@
+"""execute_plan_chunked (CSV por chunks) debe dar lo mismo que execute_plan en memoria."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import app_min
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    rng = np.random.default_rng(7)
+    n = 1000
+    df = pd.DataFrame({
+        "depto": rng.choice(["IT", "RRHH", "Ventas"], n),
+        "sede": rng.choice(["Norte", "Sur"], n),
+        "salario": rng.integers(100, 5000, n).astype(float),
+        "edad": rng.integers(18, 65, n),
+    })
+    df.loc[rng.choice(n, 40, replace=False), "salario"] = np.nan
+    path = tmp_path / "datos.csv"
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+PLANS = [
+    {"operation": "count", "group_by": [], "target": None, "filters": []},
+    {"operation": "count", "group_by": ["depto"], "target": None,
+     "filters": [{"column": "edad", "operator": ">", "value": 30}]},
+    {"operation": "sum", "group_by": [], "target": "salario",
+     "filters": [{"column": "depto", "operator": "==", "value": "IT"}]},
+    {"operation": "mean", "group_by": ["depto", "sede"], "target": "salario", "filters": []},
+    {"operation": "max", "group_by": ["sede"], "target": "edad",
+     "filters": [{"column": "depto", "operator": "in", "value": ["IT", "Ventas"]}]},
+    {"operation": "min", "group_by": [], "target": "salario",
+     "filters": [{"column": "sede", "operator": "startswith", "value": "N"}]},
+    {"operation": "median", "group_by": ["depto"], "target": "salario", "filters": []},
+]
+
+
+def _canon(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True).astype("float64", errors="ignore")
+
+
+@pytest.mark.parametrize("plan", PLANS, ids=lambda p: f"{p['operation']}-{'-'.join(p['group_by']) or 'total'}")
+def test_chunked_matches_in_memory(csv_path, plan):
+    expected = app_min.execute_plan(plan, pd.read_csv(csv_path))
+    out, _ = app_min.execute_plan_chunked(plan, csv_path, chunk_rows=97)
+    assert list(out.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(_canon(out), _canon(expected), check_dtype=False)
+
+
+def test_chunked_filter_matching_nothing(csv_path):
+    plan = {"operation": "sum", "group_by": [], "target": "salario",
+            "filters": [{"column": "depto", "operator": "==", "value": "Legal"}]}
+    expected = app_min.execute_plan(plan, pd.read_csv(csv_path))
+    out, _ = app_min.execute_plan_chunked(plan, csv_path, chunk_rows=97)
+    assert out.iloc[0, 0] == expected.iloc[0, 0] == 0
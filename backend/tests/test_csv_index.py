@@ -0,0 +1,42 @@
+"""Índice de registros CSV: ventanas y total con la misma definición de fila que read_csv."""
+import pandas as pd
+import pytest
+
+import app_min
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    lines = ['id,"no\nta"\n']
+    for i in range(40):
+        if i % 3 == 0:
+            lines.append(f'{i},"linea {i}\nsegunda ""citada""\n\ntercera"\n')  # multilínea con línea vacía
+        else:
+            lines.append(f"{i},simple {i}\n")
+        if i % 5 == 0:
+            lines.append("\n" if i % 2 else "   \n")  # líneas en blanco entre registros
+    path = tmp_path / "multilinea.csv"
+    path.write_text("".join(lines), encoding="utf-8")
+    return str(path)
+
+
+def test_total_counts_records_not_lines(csv_path):
+    idx = app_min.build_csv_row_index(csv_path, step=4)
+    assert idx["total"] == len(pd.read_csv(csv_path)) == 40
+
+
+@pytest.mark.parametrize("limit", [1, 3, 10])
+def test_windows_match_read_csv(csv_path, limit):
+    full = pd.read_csv(csv_path)
+    app_min.build_csv_row_index(csv_path, step=4)
+    for offset in range(0, len(full) + 2):
+        window = app_min.read_csv_window(csv_path, list(full.columns), offset, limit)
+        expected = full.iloc[offset:offset + limit].reset_index(drop=True)
+        pd.testing.assert_frame_equal(window, expected, check_dtype=False)
+
+
+def test_stale_index_is_rebuilt(csv_path):
+    first = app_min.get_csv_row_index(csv_path)
+    with open(csv_path, "a", encoding="utf-8") as f:
+        f.write("99,extra\n")
+    assert app_min.get_csv_row_index(csv_path)["total"] == first["total"] + 1
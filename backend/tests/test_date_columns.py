@@ -0,0 +1,65 @@
+"""Fechas en texto: optimize_dtypes no debe cambiar qué filas pasan un filtro ni cómo se muestran."""
+import pandas as pd
+import pytest
+
+import app_min
+
+
+def _frame(dates):
+    return pd.DataFrame({"fecha": dates, "monto": range(len(dates))})
+
+
+DMY = ["01/05/2024", "19/05/2024", "05/01/2024", "01/05/2024", None] * 40
+ISO = ["2024-05-01", "2024-05-19", "2024-01-05", "2024-05-01", None] * 40
+
+FILTERS = [
+    {"column": "fecha", "operator": "==", "value": "01/05/2024"},
+    {"column": "fecha", "operator": "==", "value": "2024-05-01"},
+    {"column": "fecha", "operator": "!=", "value": "2024-05-01"},
+    {"column": "fecha", "operator": ">", "value": "2024-05-02"},
+    {"column": "fecha", "operator": "in", "value": ["2024-05-01", "2024-01-05"]},
+    {"column": "fecha", "operator": "not in", "value": ["2024-05-01", "otra"]},
+    {"column": "fecha", "operator": "contains", "value": "/05/"},
+    {"column": "fecha", "operator": "contains", "value": "-05-"},
+    {"column": "fecha", "operator": "startswith", "value": "2024-05"},
+]
+
+
+@pytest.mark.parametrize("dates", [DMY, ISO], ids=["dmy", "iso"])
+@pytest.mark.parametrize("flt", FILTERS, ids=lambda f: f"{f['operator']}:{f['value']}")
+def test_filters_match_text_column(dates, flt):
+    raw = _frame(dates)
+    opt = app_min.optimize_dtypes(raw)
+    if flt["operator"] == ">" and dates is DMY:
+        pytest.skip("orden lexicográfico de D/M/A: no es una comparación de fechas en ninguno de los dos")
+    plan = {"operation": "count", "group_by": [], "target": None, "filters": [flt]}
+    before = app_min.execute_plan(plan, raw).iloc[0, 0]
+    assert app_min.execute_plan(plan, opt).iloc[0, 0] == before
+
+
+def test_day_first_dates_stay_text():
+    opt = app_min.optimize_dtypes(_frame(DMY))
+    assert not pd.api.types.is_datetime64_any_dtype(opt["fecha"].dtype)
+    eq = {"operation": "count", "group_by": [], "target": None,
+          "filters": [{"column": "fecha", "operator": "==", "value": "01/05/2024"}]}
+    contains = dict(eq, filters=[{"column": "fecha", "operator": "contains", "value": "/05/"}])
+    assert app_min.execute_plan(eq, opt).iloc[0, 0] == 80
+    assert app_min.execute_plan(contains, opt).iloc[0, 0] == 120
+
+
+def test_iso_dates_convert_and_round_trip():
+    opt = app_min.optimize_dtypes(_frame(ISO))
+    assert pd.api.types.is_datetime64_any_dtype(opt["fecha"].dtype)
+    shown = app_min._frame_rows(app_min._dates_as_text(opt.head(5)))
+    assert [r[0] for r in shown] == ISO[:5]
+
+
+@pytest.mark.parametrize("dates", [
+    ["2024-05-01", "2024-5-2"],            # sin ceros: no vuelve al mismo texto
+    ["2024-05-01", "2024-05-01 10:00"],    # con hora
+    ["2024-02-31", "2024-05-01"],          # fecha inválida
+    ["2024-05-01", "mañana"],
+])
+def test_non_round_trip_dates_stay_text(dates):
+    opt = app_min.optimize_dtypes(pd.DataFrame({"fecha": dates * 50}))
+    assert not pd.api.types.is_datetime64_any_dtype(opt["fecha"].dtype)
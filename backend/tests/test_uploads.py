@@ -0,0 +1,60 @@
+"""Uploads con el mismo contenido: el archivo se borra solo al quitar la última referencia."""
+import os
+import uuid
+
+import pytest
+
+import app_min
+
+
+@pytest.fixture
+def shared_blob():
+    content_hash = uuid.uuid4().hex
+    path = app_min.UploadStore.blob_path(content_hash, ".csv")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("a,b\n1,2\n")
+    ids = [uuid.uuid4().hex for _ in range(2)]
+    for file_id in ids:
+        app_min.upload_store.add(file_id, content_hash, ".csv", "datos.csv", 8, owner="ana")
+    return path, ids
+
+
+def test_remove_counts_remaining_references(shared_blob):
+    _, (first, second) = shared_blob
+    assert app_min.upload_store.remove(first) == 1
+    assert app_min.upload_store.remove(second) == 0
+
+
+def test_remove_missing_is_none(shared_blob):
+    _, (first, _) = shared_blob
+    app_min.upload_store.remove(first)
+    assert app_min.upload_store.remove(first) is None
+    assert app_min.upload_store.remove("no-existe") is None
+
+
+def test_discard_keeps_blob_while_shared(shared_blob):
+    path, (first, second) = shared_blob
+    assert app_min.discard_upload(first) == (path, 1)
+    assert os.path.exists(path)
+    # el segundo borrado del mismo file_id no es "la última referencia"
+    assert app_min.discard_upload(first) == (None, 0)
+    assert os.path.exists(path)
+    assert app_min.upload_store.get(second) is not None
+
+
+def test_discard_last_reference_removes_blob(shared_blob):
+    path, (first, second) = shared_blob
+    app_min.discard_upload(first)
+    assert app_min.discard_upload(second) == (path, 0)
+    assert not os.path.exists(path)
+
+
+def test_remove_lost_race_keeps_blob(shared_blob, monkeypatch):
+    # otro borrado quita el file_id entre el get y el remove de discard_upload
+    path, (first, _) = shared_blob
+    entry = app_min.upload_store.get(first)
+    app_min.upload_store.remove(first)
+    monkeypatch.setattr(app_min.upload_store, "get", lambda file_id: entry)
+    assert app_min.discard_upload(first) == (None, 0)
+    assert os.path.exists(path)